@@ -21,4 +21,11 @@ EOL
 
 python $PYTHON_SCRIPT
 
+# The local embedding model is only downloaded when embeddings aren't computed by the OpenAI API.
+if [ "$EMBEDDING_BACKEND" = "local" ]; then
+    python -c "from sentence_transformers import SentenceTransformer; SentenceTransformer('BAAI/bge-small-en-v1.5', device='cpu')"
+fi
+
+python ./main/migrate.py
+
 streamlit run ./main/app.py --server.fileWatcherType=none
\ No newline at end of file
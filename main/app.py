@@ -2,18 +2,33 @@ import asyncio
 
 import streamlit as st
 
-from rag.ingestion import ingest_pdf_async
+from database.connection import check_health, get_pool_metrics
+from rag.ingestion import ingest_pdfs_async
 from rag.rag import generate_answer
 
 st.title("QueryPDF")
 
-# Upload PDF
-pdf_file = st.file_uploader("Upload a PDF", type="pdf")
-if pdf_file is not None and not st.session_state.get("pdf_uploaded", False):
-    with st.spinner("Processing PDF. This can take several minutes..."):
-        asyncio.run(ingest_pdf_async(pdf_file))
-        st.session_state.pdf_uploaded = True
-        st.success("Document indexed! You can now ask questions about the PDF.")
+with st.sidebar.expander("Database"):
+    if check_health():
+        st.json(get_pool_metrics())
+    else:
+        st.error("The database can't be reached.")
+
+# Upload PDFs
+if "ingested_file_ids" not in st.session_state:
+    st.session_state.ingested_file_ids = set()
+
+pdf_files = st.file_uploader("Upload PDFs", type="pdf", accept_multiple_files=True)
+new_pdf_files = [pdf_file for pdf_file in pdf_files or [] if pdf_file.file_id not in st.session_state.ingested_file_ids]
+if new_pdf_files:
+    with st.spinner("Processing PDFs. This can take several minutes..."):
+        results = asyncio.run(ingest_pdfs_async(new_pdf_files))
+        st.session_state.ingested_file_ids.update(pdf_file.file_id for pdf_file in new_pdf_files)
+        for result in results:
+            if result.error:
+                st.error(f"{result.name} could not be indexed: {result.error}")
+        if any(not result.error for result in results):
+            st.success("Documents indexed! You can now ask questions about the PDFs.")
 
 # Chat interface
 if "chat_history" not in st.session_state:
@@ -0,0 +1,50 @@
+"""
+Checks that the full-text search still finds a Chunk with a unique term, like a clause number, when more Chunks match the common
+terms of the question than the candidate limit of the search. The test Chunks are inserted in a transaction that is rolled back,
+so the context store isn't changed.
+
+Usage:
+    python main/check_lexical_search.py
+"""
+import sys
+import uuid
+
+from settings import get_settings
+from database.connection import get_session
+from database.context_store import LEXICAL_SEARCH_QUERY
+from database.models import TEXT_SEARCH_CONFIG, ChunkORM, ParagraphORM, SectionORM
+
+rag_settings = get_settings().rag_settings
+
+
+def main() -> None:
+    candidate_limit = rag_settings.lexical_candidate_limit
+    # A term that can't occur in the stored documents, so the unique Chunk is the only match of that term.
+    clause_number = f"14.3.{uuid.uuid4().int % 10**9}"
+    query = f"What does clause {clause_number} of the contract say about termination?"
+
+    with get_session() as session:
+        section = SectionORM(id=uuid.uuid4())
+        paragraph = ParagraphORM(id=uuid.uuid4(), section=section, section_index=0)
+        for i in range(candidate_limit + 1):
+            ChunkORM(id=uuid.uuid4(), paragraph=paragraph, paragraph_index=i, text="Termination of the contract is covered by this clause.")
+        unique_chunk = ChunkORM(
+            id=uuid.uuid4(), paragraph=paragraph, paragraph_index=candidate_limit + 1, text=f"Clause {clause_number}: termination of the contract requires notice."
+        )
+        session.add(section)
+        session.flush()
+
+        rows = session.execute(
+            LEXICAL_SEARCH_QUERY,
+            {"config": TEXT_SEARCH_CONFIG, "query": query, "limit": rag_settings.top_n_lexical, "candidate_limit": candidate_limit}
+        ).all()
+        session.rollback()
+
+    found = any(str(row.id) == str(unique_chunk.id) for row in rows)
+    print(f"Candidate limit: {candidate_limit}, common matches: {candidate_limit + 1}, unique term found: {found}")
+    if not found:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
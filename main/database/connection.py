@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import threading
+import time
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+from functools import cache
+from typing import Any, AsyncIterator, Iterator
+
+from sqlalchemy import Engine, create_engine, make_url, text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
+from sqlalchemy.orm import Session
+
+from settings import get_settings
+
+pool_settings = get_settings().database_pool_settings
+
+
+class PoolMetrics:
+    """Collects metrics of a connection pool."""
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.checkouts = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.max_checked_out = 0
+        self._last_logged = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record_checkout(self, wait_time: float, checked_out: int) -> None:
+        """Records the time it took to check out a connection and the number of connections in use afterwards."""
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+            self.max_checked_out = max(self.max_checked_out, checked_out)
+            log_summary = time.monotonic() - self._last_logged >= pool_settings.metrics_log_interval
+            if log_summary:
+                self._last_logged = time.monotonic()
+
+        if checked_out >= _max_connections():
+            logging.warning(f"{self.name} database connection pool saturated: {checked_out} connections checked out.")
+        if log_summary:
+            logging.info(self.summary())
+
+    def as_dict(self) -> dict[str, Any]:
+        """Returns the collected metrics."""
+        with self._lock:
+            return {
+                "max_checked_out": self.max_checked_out,
+                "checkouts": self.checkouts,
+                "average_wait_time": self.total_wait_time / self.checkouts if self.checkouts else 0.0,
+                "max_wait_time": self.max_wait_time
+            }
+
+    def summary(self) -> str:
+        """Returns the collected metrics as a line of text."""
+        metrics = self.as_dict()
+        return (
+            f"{self.name} database pool: {metrics['checkouts']} checkouts, average wait {metrics['average_wait_time'] * 1000:.1f} ms, "
+            f"max wait {metrics['max_wait_time'] * 1000:.1f} ms, max {metrics['max_checked_out']} of {_max_connections()} connections checked out."
+        )
+
+
+pool_metrics = PoolMetrics(name="Sync")
+async_pool_metrics = PoolMetrics(name="Async")
+
+
+@cache
+def get_engine() -> Engine:
+    """Returns the engine that holds the connection pool shared by the context store and the vector store."""
+    engine = create_engine(
+        pool_settings.service_url,
+        pool_size=pool_settings.pool_size,
+        max_overflow=pool_settings.max_overflow,
+        pool_timeout=pool_settings.pool_timeout,
+        pool_recycle=pool_settings.pool_recycle,
+        pool_pre_ping=pool_settings.pool_pre_ping,
+        query_cache_size=pool_settings.query_cache_size
+    )
+    logging.info(f"Database engine created with pool size {pool_settings.pool_size} and max overflow {pool_settings.max_overflow}.")
+    return engine
+
+
+# asyncpg connections are bound to the event loop they were created on. Every ingestion runs in a new event loop,
+# so each loop gets its own engine, which is disposed before the loop is closed.
+_async_engines: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncEngine] = weakref.WeakKeyDictionary()
+_async_engines_lock = threading.Lock()
+
+
+def get_async_engine() -> AsyncEngine:
+    """Returns the asyncpg engine of the running event loop, which caches prepared statements per connection."""
+    loop = asyncio.get_running_loop()
+    with _async_engines_lock:
+        engine = _async_engines.get(loop)
+        if engine is None:
+            engine = _async_engines[loop] = _create_async_engine()
+    return engine
+
+
+async def dispose_async_engine() -> None:
+    """Closes the connections of the asyncpg engine of the running event loop. Must be awaited before the loop is closed."""
+    with _async_engines_lock:
+        engine = _async_engines.pop(asyncio.get_running_loop(), None)
+    if engine is not None:
+        await engine.dispose()
+
+
+def _create_async_engine() -> AsyncEngine:
+    """Creates an asyncpg engine with the pool settings."""
+    url = make_url(pool_settings.service_url).set(drivername="postgresql+asyncpg")
+    url = url.update_query_dict({"prepared_statement_cache_size": str(pool_settings.statement_cache_size)})
+    return create_async_engine(
+        url,
+        pool_size=pool_settings.pool_size,
+        max_overflow=pool_settings.max_overflow,
+        pool_timeout=pool_settings.pool_timeout,
+        pool_recycle=pool_settings.pool_recycle,
+        pool_pre_ping=pool_settings.pool_pre_ping,
+        query_cache_size=pool_settings.query_cache_size
+    )
+
+
+@contextmanager
+def get_session() -> Iterator[Session]:
+    """Checks out a connection from the shared pool and returns an ORM session bound to it."""
+    engine = get_engine()
+    start_time = time.perf_counter()
+    with engine.connect() as connection:
+        pool_metrics.record_checkout(time.perf_counter() - start_time, engine.pool.checkedout())  # type: ignore
+        with Session(bind=connection, autoflush=False) as session:
+            yield session
+
+
+@contextmanager
+def get_raw_connection() -> Iterator[Any]:
+    """Checks out a psycopg2 connection from the shared pool. Commits when the block exits without errors."""
+    engine = get_engine()
+    start_time = time.perf_counter()
+    connection = engine.raw_connection()
+    pool_metrics.record_checkout(time.perf_counter() - start_time, engine.pool.checkedout())  # type: ignore
+    try:
+        yield connection
+        connection.commit()
+    finally:
+        # Returning the connection to the pool rolls back any uncommitted transaction.
+        connection.close()
+
+
+@asynccontextmanager
+async def get_async_session() -> AsyncIterator[AsyncSession]:
+    """Checks out a connection from the async pool and returns an async ORM session bound to it."""
+    engine = get_async_engine()
+    start_time = time.perf_counter()
+    async with engine.connect() as connection:
+        async_pool_metrics.record_checkout(time.perf_counter() - start_time, engine.pool.checkedout())  # type: ignore
+        async with AsyncSession(bind=connection, autoflush=False) as session:
+            yield session
+
+
+def check_health() -> bool:
+    """Checks whether the database can be reached through the shared pool."""
+    try:
+        with get_engine().connect() as connection:
+            connection.execute(text("SELECT 1"))
+        return True
+    except Exception as e:
+        logging.error(f"Database health check failed: {e}")
+        return False
+
+
+def get_pool_metrics() -> dict[str, Any]:
+    """
+    Returns the current state and the collected metrics of the sync pool and the async pools. Every event loop has its own async pool,
+    so the async saturation is that of the most saturated pool.
+    """
+    pool = get_engine().pool
+    checked_out = pool.checkedout()  # type: ignore
+    with _async_engines_lock:
+        async_pools = [engine.pool for engine in _async_engines.values()]
+    async_checked_out = [async_pool.checkedout() for async_pool in async_pools]  # type: ignore
+    return {
+        "sync": {
+            "checked_out": checked_out,
+            "saturation": checked_out / _max_connections(),
+            "status": pool.status(),
+            **pool_metrics.as_dict()
+        },
+        "async": {
+            "pools": len(async_pools),
+            "checked_out": sum(async_checked_out),
+            "saturation": max(async_checked_out, default=0) / _max_connections(),
+            "status": [async_pool.status() for async_pool in async_pools],
+            **async_pool_metrics.as_dict()
+        }
+    }
+
+
+def _max_connections() -> int:
+    """Returns the maximum number of connections a pool can hand out."""
+    return pool_settings.pool_size + pool_settings.max_overflow
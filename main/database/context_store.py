@@ -1,56 +1,133 @@
 import logging
 from collections import defaultdict
 
-from sqlalchemy import create_engine, select
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import select, text, update
 from sqlalchemy.dialects.postgresql import UUID
 
 from settings import get_settings
-from rag.types import Section
-from .models import Base, ChunkORM, ParagraphORM, SectionORM
+from rag.types import Section, RetrievedChunk, RetrievedDocument
+from .connection import get_async_session, get_engine, get_session
+from .models import TEXT_SEARCH_CONFIG, Base, ChunkORM, CorpusVersionORM, ParagraphORM, SectionORM
 
 
 context_store_settings = get_settings().context_store_settings
 rag_settings = get_settings().rag_settings
 
-engine = create_engine(context_store_settings.service_url)
+# The query matches Chunks that contain any of the normalized terms of the question. Candidates are collected per term, so a rare 
+# term like a clause number still finds its few Chunks when the common terms of the question match far more Chunks than the limit. 
+# Chunks that contain all terms are collected as well, and only the collected candidates are ranked.
+LEXICAL_SEARCH_QUERY = text("""
+    WITH lexemes AS (
+        SELECT lexeme
+        FROM unnest(tsvector_to_array(to_tsvector(CAST(:config AS regconfig), :query))) AS lexeme
+    ),
+    query AS (
+        SELECT 
+            array_to_string(array_agg(quote_literal(lexeme)), ' | ')::tsquery AS any_terms,
+            array_to_string(array_agg(quote_literal(lexeme)), ' & ')::tsquery AS all_terms
+        FROM lexemes
+    ),
+    candidates AS (
+        (
+            SELECT chunks.id
+            FROM chunks, query
+            WHERE chunks.text_search @@ query.all_terms
+            LIMIT :candidate_limit
+        )
+        UNION
+        SELECT matches.id
+        FROM lexemes
+        CROSS JOIN LATERAL (
+            SELECT chunks.id
+            FROM chunks
+            WHERE chunks.text_search @@ quote_literal(lexemes.lexeme)::tsquery
+            LIMIT :candidate_limit
+        ) AS matches
+    )
+    SELECT chunks.id, ts_rank_cd(chunks.text_search, query.any_terms) AS rank
+    FROM candidates
+    JOIN chunks ON chunks.id = candidates.id, query
+    ORDER BY rank DESC
+    LIMIT :limit
+""")
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-Base.metadata.create_all(engine)
+def create_tables() -> None:
+    """Creates the tables of the context store if they don't exist yet and adds the full-text search index to existing tables."""
+    engine = get_engine()
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(text(
+            "ALTER TABLE chunks ADD COLUMN IF NOT EXISTS text_search tsvector "
+            f"GENERATED ALWAYS AS (to_tsvector('{TEXT_SEARCH_CONFIG}', text)) STORED"
+        ))
+        connection.execute(text("CREATE INDEX IF NOT EXISTS ix_chunks_text_search ON chunks USING gin (text_search)"))
+        connection.execute(text("INSERT INTO corpus_version (id, version) VALUES (1, 0) ON CONFLICT (id) DO NOTHING"))
+    logging.info("Context store tables created.")
 
 
-def insert_context_data(context_data: list[Section]) -> None:
-    """Creates the necessary relationships in the context data and inserts them into the context store."""
-    session = SessionLocal()
-    try:
-        for context in context_data:
-            section_orm = SectionORM(id=context.id)
-            for paragraph in context.paragraphs:
-                paragraph_orm = ParagraphORM(
-                    id=paragraph.id, 
-                    section=section_orm,
-                    section_index=paragraph.section_index
-                )
-                chunks_orm = [
-                    ChunkORM(
-                        id=chunk.id, 
-                        paragraph_index=chunk.paragraph_index, 
-                        text=chunk.text, 
-                        paragraph=paragraph_orm
-                    ) for chunk in paragraph.chunks
-                ]
-            session.add(section_orm)
-        session.commit()
-        logging.info(f"Context data inserted.")
-    except Exception as e:
-        session.rollback()
-        logging.error(f"Error: {e}")
-    finally:
-        session.close()
-
-
-def retrieve_parent_chunks(chunk_ids: list[UUID]) -> list[str]:
+async def insert_context_data_async(context_data: list[Section]) -> None:
+    """Creates the necessary relationships in the context data and inserts them into the context store asynchronously."""
+    async with get_async_session() as session:
+        try:
+            session.add_all(_to_orm(context_data))
+            await session.commit()
+            logging.info(f"Context data inserted.")
+        except Exception as e:
+            await session.rollback()
+            logging.error(f"Error: {e}")
+            raise
+
+
+def get_corpus_version() -> int:
+    """Returns the version of the corpus, which changes whenever documents are stored by any process."""
+    with get_session() as session:
+        return session.scalar(select(CorpusVersionORM.version).where(CorpusVersionORM.id == 1)) or 0
+
+
+async def increment_corpus_version_async() -> None:
+    """Increments the version of the corpus asynchronously after documents were stored."""
+    async with get_async_session() as session:
+        await session.execute(update(CorpusVersionORM).where(CorpusVersionORM.id == 1).values(version=CorpusVersionORM.version + 1))
+        await session.commit()
+
+
+def _to_orm(context_data: list[Section]) -> list[SectionORM]:
+    """Converts Sections to ORM objects with relationships between Sections, Paragraphs and Chunks."""
+    sections_orm = []
+    for context in context_data:
+        section_orm = SectionORM(id=context.id)
+        for paragraph in context.paragraphs:
+            paragraph_orm = ParagraphORM(
+                id=paragraph.id, 
+                section=section_orm,
+                section_index=paragraph.section_index
+            )
+            chunks_orm = [
+                ChunkORM(
+                    id=chunk.id, 
+                    paragraph_index=chunk.paragraph_index, 
+                    text=chunk.text, 
+                    paragraph=paragraph_orm
+                ) for chunk in paragraph.chunks
+            ]
+        sections_orm.append(section_orm)
+    return sections_orm
+
+
+def search_chunks_lexical(query: str, limit: int, candidate_limit: int) -> list[tuple[UUID, float]]:
+    """
+    Searches the Chunks with Postgres full-text search and returns their ids and ranks, best first.
+    Chunks match when they contain any of the terms of the query, so natural language questions still find exact keyword matches.
+    Each term, and all terms together, add at most candidate_limit matching Chunks to the ranking.
+    """
+    parameters = {"config": TEXT_SEARCH_CONFIG, "query": query, "limit": limit, "candidate_limit": candidate_limit}
+    with get_session() as session:
+        rows = session.execute(LEXICAL_SEARCH_QUERY, parameters).all()
+    return [(row.id, row.rank) for row in rows]
+
+
+def retrieve_parent_chunks(chunk_scores: dict[str, float]) -> list[RetrievedDocument]:
     """
     Retrieves the parent Chunks of a list of Chunks returned by semantic retrieval. It does this by:
         1. Checking the Paragraphs that the included Chunks belong to. If the included Chunks make up at least a certain percentage of all chunks in the Paragraph,
@@ -59,77 +136,109 @@ def retrieve_parent_chunks(chunk_ids: list[UUID]) -> list[str]:
            the entire Section replaces the included Paragraphs.
         3. Combining all chunks of each returned Section and of each returned orphan Paragraph into chunks of higher levels.
         4. Removing any chunks that are substrings of higher level chunks.
+    Each returned document gets the best retrieval score of the Chunks it was built from. The scores are keyed by the Chunk ids as strings.
     """
-    session = SessionLocal()
-
-    # Fetch all relevant Chunks.
-    chunks_query = session.execute(select(ChunkORM).where(ChunkORM.id.in_(chunk_ids)))
-    chunks = {chunk.id: chunk for chunk in chunks_query.scalars().all()}
+    with get_session() as session:
+        # Fetch all relevant Chunks.
+        chunks_query = session.execute(select(ChunkORM).where(ChunkORM.id.in_(list(chunk_scores))))
+        chunks = {chunk.id: chunk for chunk in chunks_query.scalars().all()}
     
-    # Group Chunks by Paragraph.
-    paragraphs_map = defaultdict(list)
-    for chunk in chunks.values():
-        paragraphs_map[chunk.paragraph_id].append(chunk)
+        # Group Chunks by Paragraph.
+        paragraphs_map = defaultdict(list)
+        for chunk in chunks.values():
+            paragraphs_map[chunk.paragraph_id].append(chunk)
     
-    returned_chunks: list[str] = []
-    returned_paragraphs: dict[UUID, ParagraphORM] = {}
-    for paragraph_id, included_chunks in paragraphs_map.items():
-        # Fetch relevant Paragraph.
-        paragraph = session.get(ParagraphORM, paragraph_id)
-        if not paragraph:
-            raise Exception("Paragraph not found in context store.")
+        returned_documents: list[RetrievedDocument] = []
+        returned_paragraphs: dict[UUID, ParagraphORM] = {}
+        paragraph_scores: dict[UUID, float] = {}
+        for paragraph_id, included_chunks in paragraphs_map.items():
+            # Fetch relevant Paragraph.
+            paragraph = session.get(ParagraphORM, paragraph_id)
+            if not paragraph:
+                raise Exception("Paragraph not found in context store.")
         
-        all_chunks = paragraph.chunks
+            all_chunks = paragraph.chunks
         
-        # Check if the included Chunks make up a certain percentage of all the Chunks of the Paragraph.
-        if len(included_chunks) / len(all_chunks) >= rag_settings.add_paragraph_threshold:
-            # Include full Paragraph.
-            returned_paragraphs[paragraph_id] = paragraph
-        else:
-            # Add chunks individually.
-            returned_chunks.extend([chunk.text for chunk in included_chunks])
+            # Check if the included Chunks make up a certain percentage of all the Chunks of the Paragraph.
+            if len(included_chunks) / len(all_chunks) >= rag_settings.add_paragraph_threshold:
+                # Include full Paragraph.
+                returned_paragraphs[paragraph_id] = paragraph
+                paragraph_scores[paragraph_id] = max(chunk_scores[str(chunk.id)] for chunk in included_chunks)
+            else:
+                # Add chunks individually.
+                returned_documents.extend([
+                    RetrievedDocument(
+                        id=chunk.id, 
+                        level="chunk", 
+                        text=chunk.text, 
+                        retrieval_score=chunk_scores[str(chunk.id)],
+                        chunks=_retrieved_chunks([chunk], chunk_scores)
+                    ) 
+                    for chunk in included_chunks
+                ])
     
-    # Group returned Paragraphs by Section.
-    sections_map = defaultdict(list)
-    for paragraph_id, paragraph in returned_paragraphs.items():
-        sections_map[paragraph.section_id].append(paragraph)
+        # Group returned Paragraphs by Section.
+        sections_map = defaultdict(list)
+        for paragraph_id, paragraph in returned_paragraphs.items():
+            sections_map[paragraph.section_id].append(paragraph)
     
-    returned_sections: list[Section] = []
-    for section_id, included_paragraphs in sections_map.items():
-        # Fetch relevant Section.
-        section = session.get(SectionORM, section_id)
-        if not section:
-            raise Exception("Section not found in context store.")
+        returned_sections: list[tuple[SectionORM, float]] = []
+        for section_id, included_paragraphs in sections_map.items():
+            # Fetch relevant Section.
+            section = session.get(SectionORM, section_id)
+            if not section:
+                raise Exception("Section not found in context store.")
         
-        all_paragraphs = section.paragraphs
+            all_paragraphs = section.paragraphs
+            section_score = max(paragraph_scores[paragraph.id] for paragraph in included_paragraphs)
         
-        # Check if the included Paragraphs make up a certain percentage of all the Paragraphs of the Section.
-        if len(included_paragraphs) / len(all_paragraphs) >= rag_settings.add_section_threshold:
-            returned_sections.append(section)  # Include full section
-        else:
-            # Merge chunks of included Paragraphs in one bigger chunk and include individually.
-            paragraph_chunks = []
-            for paragraph in included_paragraphs:
-                chunks = sorted(paragraph.chunks, key=lambda chunk: chunk.paragraph_index)
-                paragraph_chunk = " ".join([chunk.text for chunk in chunks])
-                paragraph_chunks.append(paragraph_chunk.replace("  ", " ").replace(" .", "."))
-            returned_chunks.extend(paragraph_chunks)
+            # Check if the included Paragraphs make up a certain percentage of all the Paragraphs of the Section.
+            if len(included_paragraphs) / len(all_paragraphs) >= rag_settings.add_section_threshold:
+                returned_sections.append((section, section_score))  # Include full section
+            else:
+                # Merge chunks of included Paragraphs in one bigger chunk and include individually.
+                for paragraph in included_paragraphs:
+                    returned_documents.append(RetrievedDocument(
+                        id=paragraph.id, 
+                        level="paragraph", 
+                        text=_merge_paragraph_chunks(paragraph), 
+                        retrieval_score=paragraph_scores[paragraph.id],
+                        chunks=_retrieved_chunks(sorted(paragraph.chunks, key=lambda chunk: chunk.paragraph_index), chunk_scores)
+                    ))
     
-    if returned_sections:
         # Merge chunks of Paragraphs of Sections in one bigger chunk.
-        for section in returned_sections:
-            paragraph_chunks = {}   
-            for paragraph in section.paragraphs:
-                chunks = sorted(paragraph.chunks, key=lambda chunk: chunk.paragraph_index)
-                paragraph_chunk = " ".join([chunk.text for chunk in chunks])
-                paragraph_chunks[paragraph.section_index] = (paragraph_chunk.replace("  ", " ").replace(" .", ".")) 
+        for section, section_score in returned_sections:
+            paragraph_chunks = {paragraph.section_index: _merge_paragraph_chunks(paragraph) for paragraph in section.paragraphs}
             section_chunk = "\n\n".join(dict(sorted(paragraph_chunks.items())).values())
-            returned_chunks.append(section_chunk)
+            section_chunks = [
+                chunk 
+                for paragraph in sorted(section.paragraphs, key=lambda paragraph: paragraph.section_index) 
+                for chunk in sorted(paragraph.chunks, key=lambda chunk: chunk.paragraph_index)
+            ]
+            returned_documents.append(RetrievedDocument(
+                id=section.id, 
+                level="section", 
+                text=section_chunk, 
+                retrieval_score=section_score,
+                chunks=_retrieved_chunks(section_chunks, chunk_scores)
+            ))
 
     # Remove chunks that are substrings of other chunks.
     result = []
-    for chunk in returned_chunks:
-        if not any(chunk != returned_chunk and chunk in returned_chunk for returned_chunk in returned_chunks):
-            result.append(chunk)
+    for document in returned_documents:
+        if not any(document.text != returned_document.text and document.text in returned_document.text for returned_document in returned_documents):
+            result.append(document)
 
     return result
+
+
+def _merge_paragraph_chunks(paragraph: ParagraphORM) -> str:
+    """Merges the Chunks of a Paragraph into one bigger chunk."""
+    chunks = sorted(paragraph.chunks, key=lambda chunk: chunk.paragraph_index)
+    paragraph_chunk = " ".join([chunk.text for chunk in chunks])
+    return paragraph_chunk.replace("  ", " ").replace(" .", ".")
+
+
+def _retrieved_chunks(chunks: list[ChunkORM], chunk_scores: dict[str, float]) -> list[RetrievedChunk]:
+    """Converts Chunks to RetrievedChunks with the retrieval scores of the Chunks that were returned by retrieval."""
+    return [RetrievedChunk(text=chunk.text, retrieval_score=chunk_scores.get(str(chunk.id))) for chunk in chunks]
@@ -1,20 +1,26 @@
-from sqlalchemy import Column, Integer, String, TIMESTAMP, func, ForeignKey
-from sqlalchemy.orm import declarative_base, relationship
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import Column, Computed, Index, Integer, String, TIMESTAMP, func, ForeignKey
+from sqlalchemy.orm import declarative_base, deferred, relationship
+from sqlalchemy.dialects.postgresql import TSVECTOR, UUID
 
 Base = declarative_base()
 
+TEXT_SEARCH_CONFIG = "english"
+
 
 class ChunkORM(Base):
     __tablename__ = "chunks"
     id = Column(UUID, primary_key=True, index=True)
     created_at = Column(TIMESTAMP, server_default=func.now())
     text = Column(String, unique=False, nullable=False)
+    # Only used inside full-text search queries, so it isn't loaded with the Chunks.
+    text_search = deferred(Column(TSVECTOR, Computed(f"to_tsvector('{TEXT_SEARCH_CONFIG}', text)", persisted=True)))
 
     paragraph_id = Column(UUID, ForeignKey("paragraphs.id", ondelete="CASCADE"), nullable=False)
     paragraph = relationship("ParagraphORM", back_populates="chunks")
     paragraph_index = Column(Integer, nullable=False)
 
+    __table_args__ = (Index("ix_chunks_text_search", "text_search", postgresql_using="gin"),)
+
 
 class ParagraphORM(Base):
     __tablename__ = "paragraphs"
@@ -33,3 +39,10 @@ class SectionORM(Base):
     created_at = Column(TIMESTAMP, server_default=func.now())
     
     paragraphs = relationship("ParagraphORM", back_populates="section", cascade="all, delete-orphan")
+
+
+class CorpusVersionORM(Base):
+    """Single row with a version that is incremented whenever documents are stored, so every process can tell that the corpus changed."""
+    __tablename__ = "corpus_version"
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
@@ -1,54 +1,240 @@
 import logging
 import asyncio
+from contextlib import contextmanager, nullcontext
+from functools import cache
 from datetime import datetime
-from typing import Any
+from typing import Any, Iterator, Literal, Optional
 
+import numpy as np
+import psycopg2
 from psycopg2.errors import DuplicateTable
+from psycopg2.extras import DictCursor
+from pgvector.psycopg2 import register_vector
 from timescale_vector import client
 from timescale_vector.client import uuid_from_time
 
 from settings import get_settings
-from llm.openai_interface import get_embeddings, get_embeddings_async
+from llm.embeddings import get_embeddings, get_embeddings_batch_async
+from .connection import get_raw_connection
 from .context_store import Section
 
 vec_settings = get_settings().vector_store_settings
+disk_ann_settings = vec_settings.disk_ann_settings
+openai_settings = get_settings().openai_settings
+embedding_settings = get_settings().embedding_settings
+ingestion_settings = get_settings().ingestion_settings
+rag_settings = get_settings().rag_settings
 
-vec_store = client.Sync(
-    service_url=vec_settings.service_url, 
-    table_name=vec_settings.table_name, 
-    num_dimensions=vec_settings.embedding_dimenstions
+# Chunks are stored in the table from the settings. Paragraphs and Sections are stored in their own tables, 
+# with the normalized centroids of the embeddings of their Chunks as embeddings. Only the parent level used by 
+# hierarchical retrieval is written, and only for parents with more than one Chunk, since the centroid of a single
+# Chunk is the embedding of that Chunk.
+VectorStoreLevel = Literal["chunk", "paragraph", "section"]
+ParentLevel = Literal["paragraph", "section"]
+LEVELS: list[VectorStoreLevel] = ["chunk", "paragraph", "section"]
+PARENT_LEVELS: list[ParentLevel] = ["paragraph", "section"]
+
+# Exact search over the Chunks of the selected parents. The CTE is materialized, so the parent filter is applied through 
+# the metadata indexes before the distances are computed, instead of filtering the results of the DiskANN index.
+SCOPED_SEARCH_QUERY = """
+    WITH scoped AS MATERIALIZED (
+        SELECT id, metadata, contents, embedding
+        FROM "{table_name}"
+        WHERE metadata->>'{parent_level}_id' = ANY(%s)
+    )
+    SELECT id, metadata, contents, embedding, embedding <=> %s::vector AS distance
+    FROM scoped
+    ORDER BY distance
+    LIMIT %s
+"""
+
+
+class PooledSync(client.Sync):
+    """Timescale Vector client that checks out its connections from the connection pool shared with the context store."""
+    @contextmanager
+    def connect(self) -> Iterator[Any]:
+        with get_raw_connection() as connection:
+            # Register the vector type once per pooled connection instead of on every checkout.
+            if not connection.info.get("vector_registered"):
+                try:
+                    register_vector(connection.driver_connection)
+                    connection.info["vector_registered"] = True
+                except psycopg2.ProgrammingError:
+                    # The vector extension doesn't exist yet before the tables are created.
+                    connection.rollback()
+            
+            driver_connection = connection.driver_connection
+            cursor_factory = driver_connection.cursor_factory
+            driver_connection.cursor_factory = DictCursor
+            try:
+                yield driver_connection
+            finally:
+                driver_connection.cursor_factory = cursor_factory
+
+
+# Build parameters only take effect when the index is created. Drop the index to rebuild it with new parameters.
+disk_ann_index = client.DiskAnnIndex(
+    search_list_size=disk_ann_settings.search_list_size,
+    num_neighbors=disk_ann_settings.num_neighbors,
+    max_alpha=disk_ann_settings.max_alpha,
+    storage_layout=disk_ann_settings.storage_layout,
+    num_bits_per_dimension=disk_ann_settings.num_bits_per_dimension
+)
+disk_ann_query_params = client.DiskAnnIndexParams(
+    search_list_size=disk_ann_settings.query_search_list_size,
+    rescore=disk_ann_settings.query_rescore
 )
 
-vec_store.create_tables()
-try:
-    vec_store.create_embedding_index(client.DiskAnnIndex())
-except DuplicateTable:
-    pass
 
+def get_vec_store(level: VectorStoreLevel = "chunk") -> PooledSync:
+    """Returns the vector store client of the table of a level of the hierarchy, which is created on first use."""
+    return _get_vec_store(_table_name(level))
 
-async def upsert_sections_async(sections: list[Section]) -> None:
-    """Upserts a list of documents and their embeddings into the vector database asynchronously."""
-    data = []
+
+def _table_name(level: VectorStoreLevel) -> str:
+    """Returns the name of the table of a level of the hierarchy."""
+    return vec_settings.table_name if level == "chunk" else f"{vec_settings.table_name}_{level}s"
+
+
+@cache
+def _get_vec_store(table_name: str) -> PooledSync:
+    """Returns the vector store client of a table."""
+    if embedding_settings.backend == "openai" and openai_settings.embeddings_dimensions != vec_settings.embedding_dimenstions:
+        raise ValueError(
+            f"Embedding dimensions ({openai_settings.embeddings_dimensions}) don't match "
+            f"the vector store dimensions ({vec_settings.embedding_dimenstions})."
+        )
+
+    return PooledSync(
+        service_url=vec_settings.service_url, 
+        table_name=table_name, 
+        num_dimensions=vec_settings.embedding_dimenstions
+    )
+
+
+def create_tables() -> None:
+    """
+    Creates the tables and the DiskANN indexes of the vector store if they don't exist yet, 
+    and the indexes on the parent ids of the Chunks that scope hierarchical searches.
+    """
+    for level in LEVELS:
+        vec_store = get_vec_store(level)
+        vec_store.create_tables()
+        try:
+            vec_store.create_embedding_index(disk_ann_index)
+        except DuplicateTable:
+            pass
+
+    table_name = _table_name("chunk")
+    with get_vec_store().connect() as connection, connection.cursor() as cursor:
+        for parent_level in PARENT_LEVELS:
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS "{table_name}_{parent_level}_id_idx" ON "{table_name}" ((metadata->>\'{parent_level}_id\'))'
+            )
+    logging.info("Vector store tables and indexes created.")
+
+
+def search(
+    query_embeddings: list[float], 
+    limit: int, 
+    query_params: Optional[client.QueryParams] = None,
+    level: VectorStoreLevel = "chunk",
+    filter: Optional[list[dict[str, str]]] = None
+) -> list[list[Any]]:
+    """Searches the vector store for the documents closest to the query embeddings using the DiskANN query parameters from the settings."""
+    return get_vec_store(level).search(
+        query_embedding=query_embeddings, 
+        limit=limit, 
+        filter=filter,
+        query_params=query_params or disk_ann_query_params
+    )
+
+
+def search_hierarchical(
+    query_embeddings: list[float], 
+    limit: int, 
+    top_n_parents: int, 
+    parent_level: ParentLevel = "section",
+    query_params: Optional[client.QueryParams] = None
+) -> list[list[Any]]:
+    """
+    Searches the Chunks closest to the query embeddings in two steps: first the closest Paragraphs or Sections are searched, 
+    then all Chunks of those parents are searched exactly. Parents with a single Chunk aren't stored, so the Chunks of those
+    parents are taken from a flat search instead. The results have the same format as those of a flat search.
+    """
+    parents = search(query_embeddings=query_embeddings, limit=top_n_parents, query_params=query_params, level=parent_level)
+    results = [
+        result for result in search(query_embeddings=query_embeddings, limit=limit, query_params=query_params)
+        if result[1].get(f"{parent_level}_chunks") == 1
+    ]
+    if parents:
+        query = SCOPED_SEARCH_QUERY.format(table_name=_table_name("chunk"), parent_level=parent_level)
+        with get_vec_store().connect() as connection, connection.cursor() as cursor:
+            cursor.execute(query, ([str(parent[0]) for parent in parents], str(query_embeddings), limit))
+            results.extend(cursor.fetchall())
+
+    return sorted(results, key=lambda result: result[-1])[:limit]
+
+
+async def upsert_sections_async(
+    sections: list[Section], 
+    embedding_semaphore: Optional[asyncio.Semaphore] = None, 
+    db_semaphore: Optional[asyncio.Semaphore] = None
+) -> None:
+    """
+    Upserts a list of documents and their embeddings into the vector database asynchronously.
+    Chunks are embedded in batches. The semaphores limit the concurrent embedding requests and database writes across simultaneous ingestions.
+    """
     chunks = [chunk for section in sections for paragraph in section.paragraphs for chunk in paragraph.chunks]
     
-    tasks = [get_embeddings_async(chunk.text) for chunk in chunks]
-
-    batch_size = 50
-    all_embeddings = []
-    for i in range(0, len(tasks), batch_size):
-        batch = tasks[i:i + batch_size]
-        results = await asyncio.gather(*batch)
-        all_embeddings.extend(results)
+    texts = [chunk.text for chunk in chunks]
+    batch_size = embedding_settings.batch_size
+    semaphore = embedding_semaphore or asyncio.Semaphore(ingestion_settings.embedding_concurrency)
+    batches = await asyncio.gather(*[
+        _get_embeddings_limited_async(texts[i:i + batch_size], semaphore) for i in range(0, len(texts), batch_size)
+    ])
+    all_embeddings = [embeddings for batch in batches for embeddings in batch]
     logging.info(f"Embeddings created: {len(all_embeddings)}")
 
-    for i, chunk in enumerate(chunks):
-        uuid = chunk.id
-        metadata = {"created_at": datetime.now().isoformat(), "type": chunk.type}
-        embeddings = all_embeddings[i]
-        data.append((uuid, metadata, chunk.text, embeddings))
+    chunk_embeddings = {chunk.id: embeddings for chunk, embeddings in zip(chunks, all_embeddings)}
+    created_at = datetime.now().isoformat()
+    # Parents are only stored for hierarchical retrieval. Their contents are left empty, since their texts are assembled from the context store.
+    parent_level = rag_settings.hierarchical_level if rag_settings.retrieval_mode == "hierarchical" else None
+    data: dict[VectorStoreLevel, list[tuple[Any, dict[str, Any], str, list[float]]]] = {"chunk": []}
+    if parent_level:
+        data[parent_level] = []
+    for section in sections:
+        section_chunks = [chunk for paragraph in section.paragraphs for chunk in paragraph.chunks]
+        section_metadata = {"created_at": created_at, "section_id": str(section.id)}
+        for paragraph in section.paragraphs:
+            paragraph_metadata = {**section_metadata, "paragraph_id": str(paragraph.id)}
+            # The number of Chunks of the parents tells hierarchical searches which Chunks have no stored parent.
+            chunk_metadata = {**paragraph_metadata, "paragraph_chunks": len(paragraph.chunks), "section_chunks": len(section_chunks)}
+            for chunk in paragraph.chunks:
+                data["chunk"].append((chunk.id, {**chunk_metadata, "type": chunk.type}, chunk.text, chunk_embeddings[chunk.id]))
+            if parent_level == "paragraph" and len(paragraph.chunks) > 1:
+                data["paragraph"].append((paragraph.id, paragraph_metadata, "", _centroid([chunk_embeddings[chunk.id] for chunk in paragraph.chunks])))
+        if parent_level == "section" and len(section_chunks) > 1:
+            data["section"].append((section.id, section_metadata, "", _centroid([chunk_embeddings[chunk.id] for chunk in section_chunks])))
     
-    vec_store.upsert(data)
-    logging.info(f"Documents upserted: {len(data)}")
+    async with db_semaphore or nullcontext():
+        for level, level_data in data.items():
+            await asyncio.to_thread(get_vec_store(level).upsert, level_data)
+    parents = f" and {len(data[parent_level])} {parent_level}s" if parent_level else ""
+    logging.info(f"Documents upserted: {len(data['chunk'])} chunks{parents}.")
+
+
+def _centroid(embeddings: list[list[float]]) -> list[float]:
+    """Returns the normalized mean of embeddings, so it can be compared by cosine distance like the embeddings themselves."""
+    centroid = np.mean(embeddings, axis=0)
+    norm = np.linalg.norm(centroid)
+    return (centroid / norm if norm else centroid).tolist()
+
+
+async def _get_embeddings_limited_async(texts: list[str], semaphore: asyncio.Semaphore) -> list[list[float]]:
+    """Returns the vector embeddings of a batch of input strings asynchronously, waiting for the semaphore first."""
+    async with semaphore:
+        return await get_embeddings_batch_async(texts)
 
 
 def upsert(documents: list[str]) -> None:
@@ -61,7 +247,7 @@ def upsert(documents: list[str]) -> None:
         embeddings = get_embeddings(document)
         data.append((uuid, metadata, document, embeddings))
     
-    vec_store.upsert(data)
+    get_vec_store().upsert(data)
 
 
 def upsert_elements(elements: list[dict[str, Any]]) -> None:
@@ -75,4 +261,4 @@ def upsert_elements(elements: list[dict[str, Any]]) -> None:
         embeddings = get_embeddings(document)
         data.append((uuid, metadata, document, embeddings))
     
-    vec_store.upsert(data)
+    get_vec_store().upsert(data)
@@ -0,0 +1,124 @@
+"""
+Evaluates the recall-vs-latency tradeoff of the DiskANN index on the documents in the vector store.
+
+For each combination of query parameters, the approximate search results are compared to an exact search
+(sequential scan) over the same table. Queries are either questions read from a text file (one per line)
+or documents sampled from the vector store. In hierarchical mode, the Chunks found inside the closest parents
+are compared to the exact nearest Chunks of the whole table.
+
+Usage:
+    python main/evaluate_index.py --search-list-sizes 50 100 200 --rescores 0 50 --limit 10
+    python main/evaluate_index.py --mode hierarchical --parent-level section --top-n-parents 5
+"""
+import argparse
+import statistics
+import time
+from pathlib import Path
+from typing import Optional
+
+import psycopg2
+from timescale_vector import client
+
+from settings import get_settings
+from llm.embeddings import get_embeddings
+from database.vector_store import ParentLevel, PARENT_LEVELS, search, search_hierarchical, disk_ann_settings
+
+vec_settings = get_settings().vector_store_settings
+rag_settings = get_settings().rag_settings
+
+
+def _sample_queries(num_queries: int) -> list[list[float]]:
+    """Samples stored document embeddings to use as queries."""
+    with psycopg2.connect(vec_settings.service_url) as conn, conn.cursor() as cur:
+        cur.execute(f'SELECT embedding::text FROM "{vec_settings.table_name}" ORDER BY random() LIMIT %s', (num_queries,))
+        return [[float(value) for value in row[0].strip("[]").split(",")] for row in cur.fetchall()]
+
+
+def _exact_search(query_embeddings: list[list[float]], limit: int) -> list[set[str]]:
+    """Returns the ids of the true nearest neighbours of each query by disabling index scans."""
+    results = []
+    with psycopg2.connect(vec_settings.service_url) as conn, conn.cursor() as cur:
+        cur.execute("SET enable_indexscan = off")
+        cur.execute("SET enable_bitmapscan = off")
+        for query_embedding in query_embeddings:
+            cur.execute(
+                f'SELECT id FROM "{vec_settings.table_name}" ORDER BY embedding <=> %s::vector LIMIT %s',
+                (str(query_embedding), limit)
+            )
+            results.append({str(row[0]) for row in cur.fetchall()})
+    return results
+
+
+def _evaluate(
+    query_embeddings: list[list[float]],
+    ground_truth: list[set[str]],
+    limit: int,
+    query_params: client.DiskAnnIndexParams,
+    parent_level: Optional[ParentLevel] = None,
+    top_n_parents: int = rag_settings.top_n_hierarchical
+) -> tuple[float, float, float]:
+    """
+    Returns the mean recall, median latency and 95th percentile latency (in ms) of the approximate search.
+    Evaluates the hierarchical search when a parent level is given.
+    """
+    recalls = []
+    latencies = []
+    for query_embedding, exact_ids in zip(query_embeddings, ground_truth):
+        start_time = time.perf_counter()
+        if parent_level:
+            results = search_hierarchical(
+                query_embeddings=query_embedding, 
+                limit=limit, 
+                top_n_parents=top_n_parents, 
+                parent_level=parent_level,
+                query_params=query_params
+            )
+        else:
+            results = search(query_embeddings=query_embedding, limit=limit, query_params=query_params)
+        latencies.append((time.perf_counter() - start_time) * 1000)
+
+        approximate_ids = {str(result[0]) for result in results}
+        recalls.append(len(approximate_ids & exact_ids) / len(exact_ids) if exact_ids else 1.0)
+
+    p95_latency = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0]
+    return statistics.mean(recalls), statistics.median(latencies), p95_latency
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Evaluate recall and latency of the DiskANN index.")
+    parser.add_argument("--queries", type=Path, help="Text file with one question per line. Samples stored documents if omitted.")
+    parser.add_argument("--num-queries", type=int, default=100, help="Number of stored documents to sample as queries.")
+    parser.add_argument("--limit", type=int, default=rag_settings.top_n_retrieval, help="Number of neighbours to retrieve.")
+    parser.add_argument("--search-list-sizes", type=int, nargs="+", default=[disk_ann_settings.query_search_list_size or 100])
+    parser.add_argument("--rescores", type=int, nargs="+", default=[disk_ann_settings.query_rescore or 50])
+    parser.add_argument("--mode", choices=["flat", "hierarchical"], default="flat", help="Search all Chunks or only the Chunks of the closest parents.")
+    parser.add_argument("--parent-level", choices=PARENT_LEVELS, default=rag_settings.hierarchical_level, help="Parent level of the hierarchical search.")
+    parser.add_argument("--top-n-parents", type=int, default=rag_settings.top_n_hierarchical, help="Number of parents searched by the hierarchical search.")
+    args = parser.parse_args()
+    parent_level: Optional[ParentLevel] = args.parent_level if args.mode == "hierarchical" else None
+
+    if args.queries:
+        questions = [line.strip() for line in args.queries.read_text().splitlines() if line.strip()]
+        query_embeddings = [get_embeddings(question) for question in questions]
+    else:
+        query_embeddings = _sample_queries(num_queries=args.num_queries)
+    if not query_embeddings:
+        raise ValueError("No queries to evaluate.")
+
+    ground_truth = _exact_search(query_embeddings=query_embeddings, limit=args.limit)
+    search(query_embeddings=query_embeddings[0], limit=args.limit)  # Warm up the connection pool.
+
+    print(f"Table: {vec_settings.table_name}, dimensions: {vec_settings.embedding_dimenstions}, queries: {len(query_embeddings)}, limit: {args.limit}")
+    if parent_level:
+        print(f"Hierarchical search: {args.top_n_parents} closest {parent_level}s")
+    print(f"Index: {disk_ann_settings.model_dump(exclude={'query_search_list_size', 'query_rescore'})}")
+    print(f"{'search_list_size':>16} {'rescore':>8} {'recall':>8} {'p50 (ms)':>10} {'p95 (ms)':>10}")
+    for search_list_size in args.search_list_sizes:
+        for rescore in args.rescores:
+            query_params = client.DiskAnnIndexParams(search_list_size=search_list_size, rescore=rescore)
+            recall, p50_latency, p95_latency = _evaluate(query_embeddings, ground_truth, args.limit, query_params, parent_level, args.top_n_parents)
+            print(f"{search_list_size:>16} {rescore:>8} {recall:>8.3f} {p50_latency:>10.2f} {p95_latency:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Ingests many PDF files at once. Directories are searched recursively for PDF files.
+
+Usage:
+    python main/ingest.py path/to/folder path/to/file.pdf --provider-concurrency 32
+"""
+import argparse
+import asyncio
+from pathlib import Path
+
+from settings import get_settings
+from database.connection import async_pool_metrics, pool_metrics
+from rag.ingestion import ingest_pdfs_async
+from rag.types import IngestedDocument
+
+ingestion_settings = get_settings().ingestion_settings
+
+
+def _find_pdf_files(paths: list[Path]) -> list[Path]:
+    """Returns the PDF files in the given paths, searching directories recursively."""
+    pdf_files = []
+    for path in paths:
+        if path.is_dir():
+            pdf_files.extend(sorted(file for file in path.rglob("*") if file.suffix.lower() == ".pdf"))
+        elif path.is_file():
+            pdf_files.append(path)
+        else:
+            raise FileNotFoundError(f"Path not found: {path}")
+    return pdf_files
+
+
+def _print_result(result: IngestedDocument) -> None:
+    """Prints the result of an ingested document as soon as it is done."""
+    if result.error:
+        print(f"FAILED  {result.name}: {result.error}", flush=True)
+    else:
+        print(f"DONE    {result.name}: {result.pages} pages, {result.chunks} chunks in {result.seconds:.1f}s", flush=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Ingest PDF files into the context store and the vector store.")
+    parser.add_argument("paths", type=Path, nargs="+", help="PDF files or directories containing PDF files.")
+    parser.add_argument("--provider-concurrency", type=int, default=ingestion_settings.provider_concurrency)
+    parser.add_argument("--embedding-concurrency", type=int, default=ingestion_settings.embedding_concurrency)
+    parser.add_argument("--db-concurrency", type=int, default=ingestion_settings.db_concurrency)
+    args = parser.parse_args()
+
+    pdf_files = _find_pdf_files(args.paths)
+    print(f"Ingesting {len(pdf_files)} PDF files.", flush=True)
+    results = asyncio.run(ingest_pdfs_async(
+        pdf_files=pdf_files, 
+        on_document_ingested=_print_result,
+        provider_concurrency=args.provider_concurrency,
+        embedding_concurrency=args.embedding_concurrency,
+        db_concurrency=args.db_concurrency
+    ))
+
+    failed = [result for result in results if result.error]
+    print(f"Ingested {len(results) - len(failed)} of {len(results)} PDF files.")
+    print(pool_metrics.summary())
+    print(async_pool_metrics.summary())
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
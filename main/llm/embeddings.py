@@ -0,0 +1,18 @@
+from settings import get_settings
+from llm import local_interface, openai_interface
+
+embedding_settings = get_settings().embedding_settings
+
+
+def get_embeddings(text: str) -> list[float]:
+    """Returns the vector embeddings of the input string using the embedding backend from the settings."""
+    if embedding_settings.backend == "local":
+        return local_interface.get_embeddings(text)
+    return openai_interface.get_embeddings(text)
+
+
+async def get_embeddings_batch_async(texts: list[str]) -> list[list[float]]:
+    """Returns the vector embeddings of the input strings asynchronously using the embedding backend from the settings."""
+    if embedding_settings.backend == "local":
+        return await local_interface.get_embeddings_batch_async(texts)
+    return await openai_interface.get_embeddings_batch_async(texts)
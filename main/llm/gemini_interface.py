@@ -1,6 +1,7 @@
-import time
+import asyncio
 import io
 import logging
+from functools import cache
 from typing import Optional
 
 from google import genai
@@ -10,12 +11,17 @@ from google.genai.errors import ClientError
 from settings import get_settings
 
 gemini_settings = get_settings().gemini_settings
-client = genai.Client(api_key=gemini_settings.api_key)
+
+
+@cache
+def _get_client() -> genai.Client:
+    """Returns the Gemini client, which is created on first use."""
+    return genai.Client(api_key=gemini_settings.api_key)
 
         
 async def upload_file_async(file: io.BytesIO) -> File:
     """Uploads a file to Gemini asunchronously"""
-    uploaded_file = await client.aio.files.upload(file=file, config=UploadFileConfig(mime_type='application/pdf'))
+    uploaded_file = await _get_client().aio.files.upload(file=file, config=UploadFileConfig(mime_type='application/pdf'))
     logging.info(f"uploaded file: {uploaded_file.name}")
     return uploaded_file
 
@@ -29,28 +35,31 @@ async def query_gemini_async(
     return_json: bool = False,
     json_schema: Optional[SchemaUnionDict] = None
 ) -> GenerateContentResponse:
-    """Sends a query to Gemini and returns the response."""
-    try:
-        response = await client.aio.models.generate_content(
-            model=model, 
-            contents=[prompt, file] if file else prompt,
-            config=GenerateContentConfig(
-                temperature=temperature,
-                top_p=top_p,
-                response_mime_type='application/json' if return_json else None,
-                response_schema=json_schema, 
-            ) 
-        )
-    except ClientError as e:
-        # Retry when rate limit is reached.
-        if e.code != 429:
-            raise e
-        sleep_time = 1
-        logging.info(f"Rate limit reached. Retrying in: {sleep_time}s.")
-        time.sleep(sleep_time)
-        response = await query_gemini_async(prompt=prompt, model=model, file=file)
-
-    if not response.text:
-        raise ValueError("Gemini returned no output.")
-    
-    return response
+    """Sends a query to Gemini and returns the response. Requests that hit the rate limit are retried with exponential backoff."""
+    max_retries = 5
+    for attempt in range(max_retries):
+        try:
+            response = await _get_client().aio.models.generate_content(
+                model=model, 
+                contents=[prompt, file] if file else prompt,
+                config=GenerateContentConfig(
+                    temperature=temperature,
+                    top_p=top_p,
+                    response_mime_type='application/json' if return_json else None,
+                    response_schema=json_schema, 
+                ) 
+            )
+        except ClientError as e:
+            # Retry when rate limit is reached.
+            if e.code != 429 or attempt == max_retries - 1:
+                raise e
+            sleep_time = 2 ** attempt
+            logging.info(f"Rate limit reached. Retrying in: {sleep_time}s.")
+            await asyncio.sleep(sleep_time)
+            continue
+
+        if not response.text:
+            raise ValueError("Gemini returned no output.")
+        
+        return response
+    raise Exception("Max retries exceeded for Gemini request.")
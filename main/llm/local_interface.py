@@ -0,0 +1,56 @@
+import asyncio
+import logging
+import threading
+from functools import cache
+from typing import Any
+
+from settings import get_settings
+
+embedding_settings = get_settings().embedding_settings
+vec_settings = get_settings().vector_store_settings
+
+# Inference already uses all CPU cores, so concurrent requests are run one after another.
+_inference_lock = threading.Lock()
+
+
+@cache
+def _load_model() -> Any:
+    """Loads the local embedding model once per process. Sentence Transformers is only imported when the model is needed."""
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(embedding_settings.local_model, device=embedding_settings.local_device)
+    dimensions = model.get_sentence_embedding_dimension()
+    if dimensions != vec_settings.embedding_dimenstions:
+        raise ValueError(
+            f"Local embedding model {embedding_settings.local_model} returns {dimensions} dimensions, but the vector store has "
+            f"{vec_settings.embedding_dimenstions}. Set EMBEDDING_DIMENSIONS={dimensions} and use a matching VECTOR_STORE_TABLE."
+        )
+    logging.info(f"Loaded local embedding model: {embedding_settings.local_model}.")
+
+    return model
+
+
+def get_embeddings(text: str) -> list[float]:
+    """Returns the vector embeddings of the input string."""
+    return get_embeddings_batch([text])[0]
+
+
+def get_embeddings_batch(texts: list[str]) -> list[list[float]]:
+    """Returns the vector embeddings of the input strings, computed in batches."""
+    if not all(texts):
+        raise ValueError("String to embed is empty.")
+
+    model = _load_model()
+    with _inference_lock:
+        embeddings = model.encode(
+            texts, 
+            batch_size=embedding_settings.local_batch_size, 
+            normalize_embeddings=True, 
+            convert_to_numpy=True
+        )
+    return embeddings.tolist()
+
+
+async def get_embeddings_batch_async(texts: list[str]) -> list[list[float]]:
+    """Returns the vector embeddings of the input strings asynchronously by running inference in a separate thread."""
+    return await asyncio.to_thread(get_embeddings_batch, texts)
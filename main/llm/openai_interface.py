@@ -1,5 +1,7 @@
 import logging
 import asyncio
+import weakref
+from functools import cache
 from typing import Optional, Any
 
 import openai
@@ -7,8 +9,25 @@ import openai
 from settings import get_settings
 
 openai_settings = get_settings().openai_settings
-client = openai.OpenAI(api_key=openai_settings.api_key)
-client_async = openai.AsyncOpenAI(api_key=openai_settings.api_key)
+
+
+@cache
+def _get_client() -> openai.OpenAI:
+    """Returns the OpenAI client, which is created on first use."""
+    return openai.OpenAI(api_key=openai_settings.api_key)
+
+
+# The HTTP connections of an asynchronous client are bound to the event loop they were created on, so each loop gets its own client.
+_clients_async: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, openai.AsyncOpenAI] = weakref.WeakKeyDictionary()
+
+
+def _get_client_async() -> openai.AsyncOpenAI:
+    """Returns the asynchronous OpenAI client of the running event loop, which is created on first use."""
+    loop = asyncio.get_running_loop()
+    client = _clients_async.get(loop)
+    if client is None:
+        client = _clients_async[loop] = openai.AsyncOpenAI(api_key=openai_settings.api_key)
+    return client
 
 
 def query_gpt(
@@ -24,7 +43,7 @@ def query_gpt(
     if return_json and not json_schema:
         raise ValueError("GPT should return JSON, but no JSON schema was provided.")
     
-    response = client.chat.completions.create(
+    response = _get_client().chat.completions.create(
         messages=messages,  # type: ignore
         model=model,
         response_format={"type": "json_schema", "json_schema": json_schema} if return_json else {"type": "text"}, # type: ignore
@@ -44,28 +63,34 @@ def get_embeddings(text: str) -> list[float]:
     """Returns the vector embeddings of the input string."""
     if not text:
         raise ValueError("String to embed is empty.")
-    return client.embeddings.create(input=[text], model=openai_settings.embeddings_model).data[0].embedding
+    return _get_client().embeddings.create(
+        input=[text], 
+        model=openai_settings.embeddings_model, 
+        dimensions=openai_settings.embeddings_dimensions
+    ).data[0].embedding
 
 
-async def get_embeddings_async(text: str) -> list[float]:
-    """Returns the vector embeddings of the input string asynchronously."""
-    if not text:
+async def get_embeddings_batch_async(texts: list[str]) -> list[list[float]]:
+    """Returns the vector embeddings of the input strings asynchronously with a single request."""
+    if not all(texts):
         raise ValueError("String to embed is empty.")
     
-    semaphore = asyncio.Semaphore(50)
-    async with semaphore:
-        max_retries = 5
-        for attempt in range(max_retries):
-            try:
-                response = await asyncio.wait_for(
-                    client_async.embeddings.create(input=[text], model=openai_settings.embeddings_model),
-                    timeout=10
-                )
-                logging.info("Created embedding!")
-                return response.data[0].embedding
-            except (asyncio.TimeoutError, Exception) as e:
-                wait_time = 2 ** attempt
-                logging.warning(f"Attempt {attempt+1} failed with error: {e}. Retrying in {wait_time} seconds...")
-                await asyncio.sleep(wait_time)
-        logging.error("Max retries exceeded for embedding request.")
-        raise Exception("Max retries exceeded for embedding request.")
+    max_retries = 5
+    for attempt in range(max_retries):
+        try:
+            response = await asyncio.wait_for(
+                _get_client_async().embeddings.create(
+                    input=texts, 
+                    model=openai_settings.embeddings_model, 
+                    dimensions=openai_settings.embeddings_dimensions
+                ),
+                timeout=10
+            )
+            logging.info(f"Created {len(texts)} embeddings!")
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        except (asyncio.TimeoutError, Exception) as e:
+            wait_time = 2 ** attempt
+            logging.warning(f"Attempt {attempt+1} failed with error: {e}. Retrying in {wait_time} seconds...")
+            await asyncio.sleep(wait_time)
+    logging.error("Max retries exceeded for embedding request.")
+    raise Exception("Max retries exceeded for embedding request.")
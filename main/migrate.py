@@ -0,0 +1,33 @@
+"""
+Creates the tables and indexes of the context store and the vector store. Importing the app doesn't touch the schema,
+so run this once before starting the app, e.g. from the entrypoint of the container.
+
+Usage:
+    python main/migrate.py
+"""
+import logging
+
+from sqlalchemy import text
+
+from settings import get_settings
+from database.connection import get_engine
+from database import context_store, vector_store
+
+# Arbitrary key of the advisory lock that serializes migrations of concurrently starting workers.
+MIGRATION_LOCK_KEY = 4_242_001
+
+
+def main() -> None:
+    get_settings()
+    with get_engine().connect() as connection:
+        connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        try:
+            context_store.create_tables()
+            vector_store.create_tables()
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+    logging.info("Migrations completed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+from pydantic import BaseModel
+
+from settings import get_settings
+
+answer_cache_settings = get_settings().answer_cache_settings
+
+
+class CachedAnswer(BaseModel):
+    role: str
+    answer: str
+    latency: float  # Seconds it took to generate the answer after the query was embedded.
+    created_at: float
+
+
+class SemanticAnswerCache:
+    """
+    Bounded LRU cache of generated answers. An answer is returned for a query when the embeddings of a cached query
+    with the same role are within the similarity threshold and the cached answer hasn't expired.
+    Retrieval searches all ingested documents, so the cache is invalidated entirely whenever documents are ingested.
+    Documents can be ingested by other processes, so the cache is also invalidated when the corpus version in the database changes.
+    The normalized query embeddings are kept in one preallocated matrix, so a lookup is a single matrix-vector product.
+    """
+    def __init__(self, max_size: int, ttl: float, similarity_threshold: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.hits = 0
+        self.misses = 0
+        self.latency_saved = 0.0
+        # Answers by the slot of their embeddings in the matrix, in least recently used order.
+        self._answers: OrderedDict[int, CachedAnswer] = OrderedDict()
+        self._free_slots = list(range(max_size - 1, -1, -1))
+        # Created on the first put, when the embedding dimensions are known.
+        self._embeddings: Optional[np.ndarray] = None
+        self._role_ids = np.full(max_size, -1, dtype=np.int32)  # -1 marks an empty slot.
+        self._created_at = np.zeros(max_size)
+        self._roles: dict[str, int] = {}
+        self._lock = threading.Lock()
+        # Incremented on every invalidation, so answers that were generated from an older corpus aren't cached.
+        self.generation = 0
+        self._corpus_version: Optional[int] = None
+
+    def get(self, query_embeddings: list[float], role: str, corpus_version: int) -> Optional[str]:
+        """Returns the cached answer of the most similar query, if it is similar enough and the corpus hasn't changed since it was cached."""
+        query = _normalize(np.asarray(query_embeddings, dtype=np.float32))
+        with self._lock:
+            if corpus_version != self._corpus_version:
+                if self._corpus_version is not None:
+                    self._clear()
+                    self.generation += 1
+                    logging.info(f"Answer cache invalidated, because the corpus changed to version {corpus_version}.")
+                self._corpus_version = corpus_version
+            self._remove_expired()
+
+            best_slot, best_similarity = None, -1.0
+            role_id = self._roles.get(role)
+            if self._embeddings is not None and role_id is not None:
+                similarities = self._embeddings @ query
+                similarities[self._role_ids != role_id] = -np.inf
+                best_slot = int(np.argmax(similarities))
+                best_similarity = float(similarities[best_slot])
+
+            if best_slot is None or best_similarity < self.similarity_threshold:
+                self.misses += 1
+                self._log_stats()
+                return None
+
+            answer = self._answers[best_slot]
+            self._answers.move_to_end(best_slot)
+            self.hits += 1
+            self.latency_saved += answer.latency
+            logging.info(f"Answer cache hit with similarity {best_similarity:.3f}.")
+            self._log_stats()
+            return answer.answer
+
+    def put(self, query_embeddings: list[float], role: str, answer: str, latency: float, generation: int) -> None:
+        """
+        Caches an answer and evicts the least recently used answers when the cache is full. The generation must be read 
+        before retrieval, so an answer is dropped when the cache was invalidated while it was being generated.
+        """
+        query = _normalize(np.asarray(query_embeddings, dtype=np.float32))
+        with self._lock:
+            if generation != self.generation:
+                logging.info("Answer not cached, because documents were ingested while it was generated.")
+                return
+            if self._embeddings is None or self._embeddings.shape[1] != query.shape[0]:
+                self._clear()
+                self._embeddings = np.zeros((self.max_size, query.shape[0]), dtype=np.float32)
+            if not self._free_slots:
+                self._remove_slot(next(iter(self._answers)))
+
+            slot = self._free_slots.pop()
+            now = time.monotonic()
+            self._embeddings[slot] = query
+            self._role_ids[slot] = self._roles.setdefault(role, len(self._roles))
+            self._created_at[slot] = now
+            self._answers[slot] = CachedAnswer(role=role, answer=answer, latency=latency, created_at=now)
+
+    def invalidate(self) -> None:
+        """Removes all cached answers."""
+        with self._lock:
+            self._clear()
+            self.generation += 1
+        logging.info("Answer cache invalidated.")
+
+    def _clear(self) -> None:
+        """Removes all cached answers."""
+        self._answers.clear()
+        self._free_slots = list(range(self.max_size - 1, -1, -1))
+        self._role_ids[:] = -1
+
+    def _remove_slot(self, slot: int) -> None:
+        """Removes the answer in a slot and frees the slot."""
+        del self._answers[slot]
+        self._role_ids[slot] = -1
+        self._free_slots.append(slot)
+
+    def _remove_expired(self) -> None:
+        """Removes answers that are older than the TTL."""
+        expired_slots = np.flatnonzero((self._role_ids != -1) & (time.monotonic() - self._created_at > self.ttl))
+        for slot in expired_slots:
+            self._remove_slot(int(slot))
+
+    def _log_stats(self) -> None:
+        """Logs the hit rate and the total latency saved by the cache."""
+        hit_rate = self.hits / (self.hits + self.misses)
+        logging.info(f"Answer cache hit rate: {hit_rate:.1%} ({self.hits} hits, {self.misses} misses), latency saved: {self.latency_saved:.1f}s.")
+
+
+def _normalize(embeddings: np.ndarray) -> np.ndarray:
+    """Returns embeddings with unit length, so their dot product is their cosine similarity."""
+    norm = np.linalg.norm(embeddings)
+    return embeddings / norm if norm else embeddings
+
+
+answer_cache = SemanticAnswerCache(
+    max_size=answer_cache_settings.max_size,
+    ttl=answer_cache_settings.ttl,
+    similarity_threshold=answer_cache_settings.similarity_threshold
+)
@@ -1,6 +1,6 @@
 import json
-import asyncio
 import logging
+from typing import Iterable, Iterator, Optional
 
 from google.genai.types import GenerateContentResponse
 from google.genai.types import File
@@ -12,21 +12,11 @@ from .types import ExtractedElements
 
 gemini_settings = get_settings().gemini_settings
 
+RELEVANT_TYPES = ["NarrativeText", "List", "Table", "Infographic", "Graph", "Subheading"]
+TYPES_TO_PROCESS = ["NarrativeText", "List", "Table", "Infographic", "Graph"]
 
-async def extract_elements_async(uploaded_files: list[File]) -> list[dict[str, str]]:
-    """Extracts relevant elements (Texts, Tables, Graphs, etc.) from a list of uploaded PDF files asynchronously."""
-    response_tasks = []
-    for file in uploaded_files:
-        response_tasks.append(_extract_elements_from_file_async(file))
-    responses = await asyncio.gather(*response_tasks)
 
-    logging.info(f"Resonses received: {len(responses)}.")
-    responses_processed = _process_responses(responses=responses)
-
-    return responses_processed
-
-
-async def _extract_elements_from_file_async(file: File) -> GenerateContentResponse | None:
+async def extract_elements_from_file_async(file: File) -> GenerateContentResponse | None:
     """Extracts relevant elements (Texts, Tables, Graphs, etc.) from an uploaded PDF file asynchronously and retries when a response is invalid."""
     response = await query_gemini_async(
         prompt=INSTRUCTIONS_TEXT_EXTRACTION, 
@@ -39,7 +29,7 @@ async def _extract_elements_from_file_async(file: File) -> GenerateContentRespon
     if not _response_is_valid(response=response):
         # TODO: Add more thorough retry logic that also catches API errors.
         logging.info(f"Retrying extraction for file: {file.name}.")
-        return await _extract_elements_from_file_async(file=file)
+        return await extract_elements_from_file_async(file=file)
     else:
         return response
 
@@ -70,56 +60,65 @@ def _response_is_valid(response: GenerateContentResponse) -> bool:
     return True
 
 
-def _process_responses(responses: list[GenerateContentResponse]) -> list[dict[str, str]]:
-    """Processes a list of Gemini responses into a format that is expected for ingestion."""
-    responses_cleaned = [_clean_response(response) for response in responses]
-    responses_deserialized = [json.loads(response) for response in responses_cleaned]
-
-    # Remove all irrelevant types from extracted data and flatten list of elements.
-    relevant_types = ["NarrativeText", "List", "Table", "Infographic", "Graph", "Subheading"]
-    respones_flattened = [item for response in responses_deserialized for item in response.get("elements") if item.get("type", "") in relevant_types]
-
-    # Process elements 
-    responses_processed = []
-    types_to_process = ["NarrativeText", "List", "Table", "Infographic", "Graph"]
-    previous_item = None
-    for item in respones_flattened:
-        item_type = item.get("type", "")
-        if item_type not in types_to_process:
-            previous_item = item
-            continue
-        
-        elif item_type in ["NarrativeText", "List"]:
-            # Prepend NarrativeTexts and Lists with corresponding Subheading if available.
-            if previous_item and previous_item.get("type", "") == "Subheading":
-                item["text"] = "##" + previous_item.get("text") + "\n"+ item["text"]
-            # Merge NarrativeTexts that are part of sections that span across pages and Lists that have been separated by extraction.
-            if previous_item and previous_item.get("type", "") == item_type:
-                item["text"] = previous_item["text"] + "\n\n" + item["text"]
-                responses_processed.remove(previous_item)
-            # Append Lists to preceeding NarrativeTexts, since they are part of the text.
-            if previous_item and item_type == "List" and previous_item.get("type", "") == "NarrativeText":
-                item["text"] = previous_item["text"] + "\n\n" + item["text"]
-                item["type"] = "NarrativeText"
-                responses_processed.remove(previous_item)
-
-        previous_item = item
-        responses_processed.append(item)
-    
-    logging.info(f"Responses processed into {len(responses_processed)} elements.")
-    return responses_processed
-
-
-def _clean_response(response: GenerateContentResponse) -> str:
-    """Cleans a Gemini response so it can be processed without errors."""
+def parse_response(response: GenerateContentResponse) -> list[dict[str, str]]:
+    """Parses a Gemini response into the relevant, non-empty elements of its page."""
     if not response.text:
         raise ValueError("No text in response.")
-    
-    response_cleaned = {}
-    text_deserialized = json.loads(response.text.replace("```json", "").replace("```", ""))
 
-    response_cleaned["elements"] = [element for element in text_deserialized["elements"] if element["text"]]
-    
-    response_cleaned = json.dumps(response_cleaned)
-
-    return response_cleaned
+    text_deserialized = json.loads(response.text.replace("```json", "").replace("```", ""))
+    return [
+        {"type": element["type"], "text": element["text"]} 
+        for element in text_deserialized["elements"] 
+        if element["text"] and element.get("type", "") in RELEVANT_TYPES
+    ]
+
+
+class ElementMerger:
+    """
+    Merges the relevant elements of consecutive pages in a single pass, so elements can be added page by page as the pages arrive.
+    An element is held back until the next element shows it can't be merged anymore, so only one element is kept in memory.
+    """
+    def __init__(self) -> None:
+        self.elements_processed = 0
+        self._pending_item: Optional[dict[str, str]] = None
+        self._previous_item: Optional[dict[str, str]] = None
+
+    def add(self, elements: Iterable[dict[str, str]]) -> Iterator[dict[str, str]]:
+        """Adds elements in document order and yields the elements that can't be merged with later elements anymore."""
+        for item in elements:
+            previous_item = self._previous_item
+            item_type = item.get("type", "")
+            if item_type not in TYPES_TO_PROCESS:
+                self._previous_item = item
+                continue
+
+            merged = False
+            if item_type in ["NarrativeText", "List"]:
+                # Prepend NarrativeTexts and Lists with corresponding Subheading if available.
+                if previous_item and previous_item.get("type", "") == "Subheading":
+                    item["text"] = "##" + previous_item["text"] + "\n"+ item["text"]
+                # Merge NarrativeTexts that are part of sections that span across pages and Lists that have been separated by extraction.
+                if previous_item and previous_item.get("type", "") == item_type:
+                    item["text"] = previous_item["text"] + "\n\n" + item["text"]
+                    merged = True
+                # Append Lists to preceeding NarrativeTexts, since they are part of the text.
+                if previous_item and item_type == "List" and previous_item.get("type", "") == "NarrativeText":
+                    item["text"] = previous_item["text"] + "\n\n" + item["text"]
+                    item["type"] = "NarrativeText"
+                    merged = True
+
+            # A merged item replaces the pending item, which is always the previous item.
+            if self._pending_item is not None and not merged:
+                self.elements_processed += 1
+                yield self._pending_item
+            self._pending_item = item
+            self._previous_item = item
+
+    def flush(self) -> Iterator[dict[str, str]]:
+        """Yields the element that is held back. Call this after the elements of the last page were added."""
+        if self._pending_item is not None:
+            self.elements_processed += 1
+            yield self._pending_item
+        self._pending_item = None
+        self._previous_item = None
+        logging.info(f"Responses processed into {self.elements_processed} elements.")
@@ -1,120 +1,311 @@
 import io
+import time
 import asyncio
 import logging
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional, Sequence
 
 import pymupdf
 from streamlit.runtime.uploaded_file_manager import UploadedFile
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from google.genai.types import File
 
 from settings import get_settings
 from llm.gemini_interface import upload_file_async
-from database.context_store import insert_context_data
+from database.connection import dispose_async_engine
+from database.context_store import increment_corpus_version_async, insert_context_data_async
 from database.vector_store import upsert_sections_async
-from .extraction import extract_elements_async
-from .types import Chunk, Paragraph, Section
+from .answer_cache import answer_cache
+from .extraction import ElementMerger, extract_elements_from_file_async, parse_response
+from .types import Chunk, IngestedDocument, Paragraph, Section
 
 ingestion_settings = get_settings().ingestion_settings
 gemini_settings = get_settings().gemini_settings
 
+text_splitter = RecursiveCharacterTextSplitter(
+    chunk_size=ingestion_settings.chunk_size,
+    chunk_overlap=0,
+    separators=ingestion_settings.separators
+)
 
-async def ingest_pdf_async(pdf_file: UploadedFile) -> None:
+
+@dataclass
+class _DocumentIngestion:
+    """
+    Progress of a document that is being ingested. Responses are parsed as soon as they arrive. Pages that arrive before 
+    the pages preceding them wait in a reorder buffer, and all other pages are queued in page order for storage. The queue is 
+    bounded, so extraction waits for storage instead of holding every extracted page in memory.
+    The PDF is opened when its first page is split and closed after its last page is split.
+    """
+    name: str
+    source: Path | UploadedFile
+    page_count: int
+    pdf: Optional[pymupdf.Document] = None  # Open only while the pages of the document are scheduled.
+    reorder_buffer: dict[int, list[dict[str, str]]] = field(default_factory=dict)
+    next_page: int = 0
+    ordered_pages: asyncio.Queue[Optional[list[dict[str, str]]]] = field(  # None after the last page.
+        default_factory=lambda: asyncio.Queue(maxsize=ingestion_settings.max_queued_pages)
+    )
+    start_time: float = field(default_factory=time.perf_counter)
+    error: Optional[str] = None
+
+    async def add_page(self, page_num: int, elements: list[dict[str, str]]) -> None:
+        """
+        Adds the elements of an extracted page and queues all pages whose preceding pages are extracted as well.
+        Waits while the queue is full.
+        """
+        # The pages of a failed document aren't stored, so their elements don't have to be kept.
+        self.reorder_buffer[page_num] = elements if not self.error else []
+        while self.next_page in self.reorder_buffer:
+            await self.ordered_pages.put(self.reorder_buffer.pop(self.next_page))
+            self.next_page += 1
+        if self.next_page == self.page_count:
+            await self.ordered_pages.put(None)
+
+
+async def ingest_pdfs_async(
+    pdf_files: Sequence[Path | UploadedFile], 
+    on_document_ingested: Optional[Callable[[IngestedDocument], None]] = None,
+    provider_concurrency: int = ingestion_settings.provider_concurrency,
+    embedding_concurrency: int = ingestion_settings.embedding_concurrency,
+    db_concurrency: int = ingestion_settings.db_concurrency
+) -> list[IngestedDocument]:
     """
-    Main pipeline for ingestion of an uploaded PDF file. It performs the following steps:
-        1. The PDF file is split into pages.
+    Main pipeline for ingestion of one or more PDF files. It performs the following steps:
+        1. The PDF files are split into pages.
         2. The pages are uploaded to Gemini.
         3. Relevant elements (Paragraphs, Tables, Graphs, etc.) are extracted from the pages.
         4. Text elements are hierarchically divided into chunks. This hierarchy is the chunk context.
         5. The context is inserted in the context store.
         6. The lowest level chunks are upserted into the vector store as docments.
+    Pages of all files share one pool of Gemini workers and are scheduled round-robin across the files, so a large file can't
+    starve the others. Pages are stored in page order while later pages are still being extracted, and each file is reported 
+    through on_document_ingested when it is stored.
+    Cached answers are invalidated after each stored file. The concurrency limits are shared by all files.
     """
-    import time
     start_time = time.perf_counter()
 
-    pdf_pages = _split_pdf(pdf_file=pdf_file)
-    
-    uploaded_files = await _upload_pages_async(pdf_pages=pdf_pages)
-    extracted_elements = await extract_elements_async(uploaded_files=uploaded_files)
-    elements_chunked = _chunk_elements(elements=extracted_elements)
-    insert_context_data(elements_chunked)
-    await upsert_sections_async(elements_chunked)
+    embedding_semaphore = asyncio.Semaphore(embedding_concurrency)
+    db_semaphore = asyncio.Semaphore(db_concurrency)
+    results: list[IngestedDocument] = []
+    store_tasks: list[asyncio.Task] = []
+
+    def report_result(result: IngestedDocument) -> None:
+        results.append(result)
+        if result.error:
+            logging.error(f"Document {len(results)}/{len(pdf_files)} failed: {result.name}: {result.error}")
+        else:
+            logging.info(f"Document {len(results)}/{len(pdf_files)} done: {result.name} ({result.pages} pages, {result.chunks} chunks) in {result.seconds:.1f} seconds.")
+        if on_document_ingested:
+            on_document_ingested(result)
+
+    # A file that can't be opened fails on its own instead of aborting the other files.
+    documents: list[_DocumentIngestion] = []
+    for pdf_file in pdf_files:
+        try:
+            documents.append(_count_pages(pdf_file))
+        except Exception as e:
+            report_result(IngestedDocument(name=pdf_file.name, pages=0, seconds=0.0, error=f"PDF could not be opened: {e}"))
+
+    async def store_document_async(document: _DocumentIngestion) -> None:
+        result = await _store_document_async(document, embedding_semaphore=embedding_semaphore, db_semaphore=db_semaphore)
+        if result.chunks:
+            # The document can be retrieved now, so cached answers of all processes may be outdated.
+            answer_cache.invalidate()
+            try:
+                await increment_corpus_version_async()
+            except Exception as e:
+                logging.error(f"Corpus version could not be incremented after storing {result.name}: {e}")
+        report_result(result)
+
+    async def extract_pages_async(pages: Iterator[tuple[_DocumentIngestion, int]]) -> None:
+        # Workers pull pages from the same schedule, so the number of workers bounds the concurrent Gemini requests.
+        for document, page_num in pages:
+            elements: list[dict[str, str]] = []
+            # The remaining pages of a failed document are skipped, since the document isn't stored anymore.
+            if document.error:
+                # The last page of a failed document isn't split, so its PDF is closed here.
+                if page_num == document.page_count - 1:
+                    _close_pdf(document)
+            else:
+                try:
+                    uploaded_file = await upload_file_async(file=_split_page(document, page_num))
+                    response = await extract_elements_from_file_async(file=uploaded_file)
+                    elements = parse_response(response)  # type: ignore
+                except Exception as e:
+                    logging.error(f"Extraction of page {page_num} of {document.name} failed: {e}")
+                    document.error = document.error or str(e)
+
+            await document.add_page(page_num, elements)
+
+    # Every document is stored while its pages are extracted.
+    store_tasks.extend(asyncio.create_task(store_document_async(document)) for document in documents)
+    pages = _schedule_pages_round_robin(documents, max_open_documents=ingestion_settings.max_open_documents)
+    try:
+        await asyncio.gather(*[extract_pages_async(pages) for _ in range(provider_concurrency)])
+        await asyncio.gather(*store_tasks)
+    finally:
+        # The engine is bound to this event loop, which is closed after the ingestion.
+        await dispose_async_engine()
 
     end_time = time.perf_counter()
-    logging.info(f"PDF ingested in {end_time-start_time} seconds.")
-    
-
-def _split_pdf(pdf_file: UploadedFile) -> list[io.BytesIO]:
-    """Splits a PDF file into its individual pages.""" 
-    doc = pymupdf.open(stream=pdf_file.read(), filetype='pdf')
-    pdf_pages = []
-    for page_num in range(len(doc)):
+    total_pages = sum(result.pages for result in results)
+    logging.info(
+        f"{len(results)} PDFs ({total_pages} pages) ingested in {end_time-start_time} seconds "
+        f"({total_pages / (end_time-start_time):.2f} pages per second)."
+    )
+    return results
+
+
+def _count_pages(pdf_file: Path | UploadedFile) -> _DocumentIngestion:
+    """Reads the page count of a PDF file from disk or from an upload. The PDF is closed again until its pages are scheduled."""
+    with _open_pdf(pdf_file) as pdf:
+        document = _DocumentIngestion(name=pdf_file.name, source=pdf_file, page_count=len(pdf))
+    if document.page_count == 0:
+        document.ordered_pages.put_nowait(None)
+    return document
+
+
+def _open_pdf(pdf_file: Path | UploadedFile) -> pymupdf.Document:
+    """Opens a PDF file from disk or from an upload."""
+    if isinstance(pdf_file, Path):
+        return pymupdf.open(pdf_file, filetype='pdf')
+    return pymupdf.open(stream=pdf_file.getvalue(), filetype='pdf')
+
+
+def _close_pdf(document: _DocumentIngestion) -> None:
+    """Closes the PDF of a document if it is open."""
+    if document.pdf is not None:
+        document.pdf.close()
+        document.pdf = None
+
+
+def _schedule_pages_round_robin(documents: list[_DocumentIngestion], max_open_documents: int) -> Iterator[tuple[_DocumentIngestion, int]]:
+    """
+    Yields the pages of the documents, taking one page from each scheduled document in turn. At most max_open_documents
+    documents are scheduled at the same time, so large folders don't run out of file descriptors. The next document is
+    scheduled once all pages of a scheduled document are yielded.
+    """
+    waiting = deque(document for document in documents if document.page_count > 0)
+    scheduled: list[tuple[_DocumentIngestion, Iterator[int]]] = []
+    while waiting or scheduled:
+        while waiting and len(scheduled) < max_open_documents:
+            document = waiting.popleft()
+            scheduled.append((document, iter(range(document.page_count))))
+        for document, page_nums in list(scheduled):
+            page_num = next(page_nums)
+            if page_num == document.page_count - 1:
+                scheduled.remove((document, page_nums))
+            yield document, page_num
+
+
+def _split_page(document: _DocumentIngestion, page_num: int) -> io.BytesIO:
+    """
+    Copies a single page of a document into a new PDF file. Pages are split right after they are scheduled, so the PDF is
+    opened for the first page and closed after the last page.
+    """
+    if document.pdf is None:
+        document.pdf = _open_pdf(document.source)
+    try:
         new_doc = pymupdf.open()
-        new_doc.insert_pdf(doc, from_page=page_num, to_page=page_num)
+        new_doc.insert_pdf(document.pdf, from_page=page_num, to_page=page_num)
+    finally:
+        if page_num == document.page_count - 1:
+            _close_pdf(document)
+
+    pdf_bytes_io = io.BytesIO()
+    new_doc.save(pdf_bytes_io)
+    new_doc.close()
+
+    pdf_bytes_io.seek(0)
+    return pdf_bytes_io
+
+
+async def _store_document_async(
+    document: _DocumentIngestion, 
+    embedding_semaphore: asyncio.Semaphore, 
+    db_semaphore: asyncio.Semaphore
+) -> IngestedDocument:
+    """
+    Chunks the extracted elements of a document and stores them in the context store and the vector store while later pages are still
+    being extracted. Pages are merged and chunked in page order as soon as all preceding pages are extracted, and Sections are stored in
+    batches, so only out-of-order pages and one batch are held in memory. Storage isn't atomic: when a page or a batch fails, the batches 
+    that were stored before stay in the stores and the document is reported as failed.
+    """
+    merger = ElementMerger()
+    batch: list[Section] = []
+    chunks = 0
+    elements: Optional[list[dict[str, str]]] = []
+    try:
+        while (elements := await document.ordered_pages.get()) is not None:
+            if document.error:
+                break
+            batch.extend(_chunk_elements(elements=merger.add(elements)))
+            if _count_chunks(batch) >= ingestion_settings.store_batch_size:
+                chunks += await _store_sections_async(batch, embedding_semaphore=embedding_semaphore, db_semaphore=db_semaphore)
+                batch = []
+
+        if not document.error:
+            batch.extend(_chunk_elements(elements=merger.flush()))
+            if batch:
+                chunks += await _store_sections_async(batch, embedding_semaphore=embedding_semaphore, db_semaphore=db_semaphore)
+            logging.info("Chunking of elements completed.")
+    except Exception as e:
+        logging.error(f"Storing {document.name} failed: {e}")
+        document.error = document.error or str(e)
 
-        pdf_bytes_io = io.BytesIO()
-        new_doc.save(pdf_bytes_io)
-        new_doc.close()
+    # The remaining pages of a failed document are still taken from the queue, so the extraction workers don't wait forever.
+    while elements is not None:
+        elements = await document.ordered_pages.get()
 
-        pdf_bytes_io.seek(0)
-        pdf_pages.append(pdf_bytes_io)
-    logging.info(f"split pdf in {len(pdf_pages)} pages!")
-    return pdf_pages
+    return IngestedDocument(
+        name=document.name, 
+        pages=document.page_count, 
+        chunks=chunks, 
+        seconds=time.perf_counter() - document.start_time, 
+        error=document.error
+    )
+
+
+async def _store_sections_async(
+    sections: list[Section], 
+    embedding_semaphore: asyncio.Semaphore, 
+    db_semaphore: asyncio.Semaphore
+) -> int:
+    """Stores a batch of Sections in the context store and the vector store and returns the number of stored Chunks."""
+    async with db_semaphore:
+        await insert_context_data_async(sections)
+    await upsert_sections_async(sections, embedding_semaphore=embedding_semaphore, db_semaphore=db_semaphore)
+    return _count_chunks(sections)
 
 
-async def _upload_pages_async(pdf_pages: list[io.BytesIO]) -> list[File]:
-    """Uploads a PDF file split into individual pages to Gemini asynchronously."""
-    upload_tasks = []
-    for page in pdf_pages:
-        upload_tasks.append(upload_file_async(file=page))
-    uploaded_files = await asyncio.gather(*upload_tasks)
-    return uploaded_files
+def _count_chunks(sections: list[Section]) -> int:
+    """Returns the number of Chunks in a list of Sections."""
+    return sum(len(paragraph.chunks) for section in sections for paragraph in section.paragraphs)
 
 
-def _chunk_elements(elements: list[dict[str, str]]) -> list[Section]:
+def _chunk_elements(elements: Iterable[dict[str, str]]) -> Iterator[Section]:
     """Divides text elements into smaller chunks and creates a hierarchical structure for hierarchical retrieval."""
-    elements_chunked = []
     for element in elements:
         element_type = element["type"]
-        if element_type != "NarrativeText":
-            section = Section(paragraphs=[
-                Paragraph(
-                    section_index=0, 
-                    chunks=[Chunk(text=element["text"], type=element_type, paragraph_index=0)]
-                )
-            ])
-            elements_chunked.append(section)
-            continue
-        if element["text"].find("\n\n") == -1 and len(element) <= ingestion_settings.chunk_size:
-            section = Section(paragraphs=[
+        if element_type != "NarrativeText" or (element["text"].find("\n\n") == -1 and len(element["text"]) <= ingestion_settings.chunk_size):
+            yield Section(paragraphs=[
                 Paragraph(
                     section_index=0, 
                     chunks=[Chunk(text=element["text"], type=element_type, paragraph_index=0)]
                 )
             ])
-            elements_chunked.append(section)
             continue
         
-        full_text = element["text"]
-        paragraphs = full_text.split("\n\n")
-
         # Remove empty strings
-        paragraphs = [paragraph for paragraph in paragraphs if paragraph]
+        paragraphs = [paragraph for paragraph in element["text"].split("\n\n") if paragraph]
 
-        paragraphs_chunked = _split_paragraphs(paragraphs=paragraphs)
-        
-        element_chunked = Section(paragraphs=paragraphs_chunked)
-        elements_chunked.append(element_chunked)
-    logging.info("Chunking of elements completed.")
-    return elements_chunked
+        yield Section(paragraphs=_split_paragraphs(paragraphs=paragraphs))
 
 
 def _split_paragraphs(paragraphs: list[str]) -> list[Paragraph]:
     """Splits paragraphs in chunks if paragraph is bigger than the chunk size."""
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=ingestion_settings.chunk_size,
-        chunk_overlap=0,
-        separators=ingestion_settings.separators
-    )
     paragraphs_chunked = []
     for i, paragraph in enumerate(paragraphs):
         if len(paragraph) <= ingestion_settings.chunk_size:
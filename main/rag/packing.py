@@ -0,0 +1,80 @@
+import logging
+from functools import cache
+
+import tiktoken
+
+from .types import RetrievedDocument
+
+
+def pack_documents(documents: list[RetrievedDocument], token_budget: int, model: str) -> list[str]:
+    """
+    Packs documents in ranking order into a context that fits in the token budget, counted with the tokenizer of the target model.
+    Documents that don't fit are trimmed to their highest scoring Chunks instead of being dropped entirely.
+    """
+    separator_tokens = count_tokens("\n\n", model=model)
+
+    result = []
+    tokens_used = 0
+    trimmed_documents = 0
+    for doc in documents:
+        remaining_tokens = token_budget - tokens_used - (separator_tokens if result else 0)
+        if remaining_tokens <= 0:
+            break
+
+        doc_tokens = count_tokens(doc.text, model=model)
+        if doc_tokens <= remaining_tokens:
+            text = doc.text
+        else:
+            text, doc_tokens = _trim_document(doc=doc, token_budget=remaining_tokens, model=model)
+            if not text:
+                continue
+            trimmed_documents += 1
+
+        result.append(text)
+        tokens_used += doc_tokens + (separator_tokens if len(result) > 1 else 0)
+
+    logging.info(
+        f"Summarization context: {tokens_used} of {token_budget} tokens used, "
+        f"{len(result)} of {len(documents)} documents included, {trimmed_documents} trimmed."
+    )
+    return result
+
+
+def count_tokens(text: str, model: str) -> int:
+    """Counts the tokens of a text with the tokenizer of a model."""
+    return len(_get_encoding(model).encode(text))
+
+
+@cache
+def _get_encoding(model: str) -> tiktoken.Encoding:
+    """
+    Returns the tokenizer of a model, falling back to the tokenizer of the most recent models. The encodings are bundled
+    in the Docker image through TIKTOKEN_CACHE_DIR, elsewhere they are downloaded on first use.
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def _trim_document(doc: RetrievedDocument, token_budget: int, model: str) -> tuple[str, int]:
+    """
+    Trims a document to the Chunks that fit in the token budget. Chunks returned by retrieval are picked first, best scoring first,
+    followed by the remaining Chunks in document order. The picked Chunks are returned in document order.
+    """
+    separator_tokens = count_tokens("\n\n", model=model)
+    ranked_chunks = sorted(
+        enumerate(doc.chunks),
+        key=lambda x: (x[1].retrieval_score is None, -(x[1].retrieval_score or 0.0), x[0])
+    )
+
+    picked_chunks: dict[int, str] = {}
+    tokens_used = 0
+    for position, chunk in ranked_chunks:
+        chunk_tokens = count_tokens(chunk.text, model=model) + (separator_tokens if picked_chunks else 0)
+        if tokens_used + chunk_tokens > token_budget:
+            continue
+        picked_chunks[position] = chunk.text
+        tokens_used += chunk_tokens
+
+    return "\n\n".join(dict(sorted(picked_chunks.items())).values()), tokens_used
@@ -1,25 +1,47 @@
 import json
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any
 
-import torch
-from transformers import AutoTokenizer, AutoModelForSequenceClassification
-
 from settings import get_settings
-from llm.openai_interface import query_gpt, get_embeddings
-from database.vector_store import vec_store
-from database.context_store import retrieve_parent_chunks
+from llm.openai_interface import query_gpt
+from llm.embeddings import get_embeddings
+from database.vector_store import search, search_hierarchical
+from database.context_store import get_corpus_version, retrieve_parent_chunks, search_chunks_lexical
+from rag.answer_cache import answer_cache
 from rag.instructions import INSTRUCTIONS_REPHRASING, INSTRUCTIONS_SUMMARIZATION
+from rag.packing import count_tokens, pack_documents
+from rag.reranking import rerank_documents
+from rag.types import RetrievedDocument
 
 rag_settings = get_settings().rag_settings
+openai_settings = get_settings().openai_settings
+answer_cache_settings = get_settings().answer_cache_settings
+
+# Runs the lexical search and the vector search of a query concurrently.
+_search_executor = ThreadPoolExecutor(thread_name_prefix="search")
 
 
 def generate_answer(message_history: list[dict[str, str]], role: str) -> str:
     """"""
     # TODO: Add sources to final answer
     query = _rephrase_query(message_history=message_history)
-    results = _retrieve_documents(query=query, top_n=rag_settings.top_n_retrieval, max_distance=rag_settings.max_distance_retrieval)
-    results = _rerank_documents(query=query, documents=results, top_n=rag_settings.top_n_reranking, min_score=rag_settings.min_score_reranking)
+    query_embeddings = get_embeddings(text=query)
+
+    if answer_cache_settings.enabled:
+        cached_response = answer_cache.get(query_embeddings=query_embeddings, role=role, corpus_version=get_corpus_version())
+        if cached_response is not None:
+            return cached_response
+    cache_generation = answer_cache.generation
+    start_time = time.perf_counter()
+
+    results = _retrieve_documents(query=query, query_embeddings=query_embeddings, top_n=rag_settings.top_n_retrieval, max_distance=rag_settings.max_distance_retrieval)
+    results = rerank_documents(query=query, documents=results, top_n=rag_settings.top_n_reranking, min_score=rag_settings.min_score_reranking)
     response = _summarize_documents(query=query, documents=results, role=role)
+
+    if answer_cache_settings.enabled:
+        answer_cache.put(query_embeddings=query_embeddings, role=role, answer=response, latency=time.perf_counter() - start_time, generation=cache_generation)
     
     return response
     
@@ -35,50 +57,69 @@ def _rephrase_query(message_history: list[dict[str, str]]) -> str:
     return result
 
 
-def _retrieve_documents(query: str, top_n: int, max_distance: float) -> list[str]:
-    query_embeddings = get_embeddings(text=query)
-    results = vec_store.search(query_embedding=query_embeddings, limit=top_n) # TODO: Implement filters
-    if not results:
-        return []
-
-    relevant_documents = [doc for doc in results if doc[-1] <= max_distance]
-    parent_chunks = retrieve_parent_chunks(chunk_ids=[doc[0] for doc in relevant_documents])
-    
-    return parent_chunks
-
-
-def _rerank_documents(query: str, documents: list[str], top_n: int, min_score: float) -> list[str]:
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+def _retrieve_documents(query: str, query_embeddings: list[float], top_n: int, max_distance: float) -> list[RetrievedDocument]:
+    if not rag_settings.hybrid_retrieval:
+        results = _search_vector_store(query_embeddings=query_embeddings, top_n=top_n)
+        if not results:
+            return []
 
-    model_path = "models/alibaba"
+        # Without hybrid retrieval, cosine distances are turned into similarities, so higher retrieval scores are better.
+        chunk_scores = {str(doc[0]): 1 - doc[-1] for doc in results if doc[-1] <= max_distance}
+        return retrieve_parent_chunks(chunk_scores=chunk_scores)
 
-    tokenizer = AutoTokenizer.from_pretrained(model_path)
-    model = AutoModelForSequenceClassification.from_pretrained(
-        model_path,
-        revision="815b4a86b71f0ecba053e5814a6c24aa7199301e",  # Ensures using a specific safe revision
-        trust_remote_code=True,
-        torch_dtype=torch.float16
+    lexical_future = _search_executor.submit(
+        search_chunks_lexical, 
+        query=query, 
+        limit=rag_settings.top_n_lexical, 
+        candidate_limit=rag_settings.lexical_candidate_limit
     )
-    model.to(device)
-    model.eval()
-
-    pairs = [[query, doc] for doc in documents]
-    with torch.no_grad():
-        inputs = tokenizer(pairs, padding=True, truncation=True, return_tensors='pt', max_length=8192)
-        inputs = {key: value.to(device) for key, value in inputs.items()}
-        scores = model(**inputs, return_dict=True).logits.view(-1, ).float()
-
-    ranked_documents = sorted(zip(documents, scores), key=lambda x: x[1], reverse=True) # Reverse order improves summarization step slightly. For more info, see: https://arxiv.org/pdf/2407.01219
-    result = [doc for doc, score in ranked_documents[:top_n] if score >= min_score]
-    
-    return result
+    vector_results = _search_vector_store(query_embeddings=query_embeddings, top_n=top_n)
+    lexical_results = lexical_future.result()
 
+    vector_ranking = [doc[0] for doc in vector_results if doc[-1] <= max_distance]
+    lexical_ranking = [chunk_id for chunk_id, _ in lexical_results]
+    if not vector_ranking and not lexical_ranking:
+        return []
 
-def _summarize_documents(query: str, documents: list[str], role: str) -> str:
-    documents_content = [doc for doc in documents]
+    # With hybrid retrieval, the retrieval scores are reciprocal rank fusion scores. They are only comparable within a query, 
+    # roughly between 1 / (rrf_k + top_n) for a single low rank and 2 / (rrf_k + 1) for the top of both rankings.
+    chunk_scores = _reciprocal_rank_fusion(rankings=[vector_ranking, lexical_ranking], k=rag_settings.rrf_k)
+    chunk_scores = dict(sorted(chunk_scores.items(), key=lambda item: item[1], reverse=True)[:top_n])
+    return retrieve_parent_chunks(chunk_scores=chunk_scores)
+
+
+def _search_vector_store(query_embeddings: list[float], top_n: int) -> list[list[Any]]:
+    """Searches the Chunks closest to the query embeddings with the retrieval mode from the settings."""
+    if rag_settings.retrieval_mode == "hierarchical":
+        return search_hierarchical(
+            query_embeddings=query_embeddings, 
+            limit=top_n, 
+            top_n_parents=rag_settings.top_n_hierarchical, 
+            parent_level=rag_settings.hierarchical_level
+        )
+    return search(query_embeddings=query_embeddings, limit=top_n) # TODO: Implement filters
+
+
+def _reciprocal_rank_fusion(rankings: list[list[Any]], k: int) -> dict[str, float]:
+    """Fuses rankings of Chunk ids into one score per Chunk, so Chunks ranked high by any of the rankings get a high score."""
+    scores: dict[str, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[str(chunk_id)] += 1 / (k + rank)
+    return dict(scores)
+
+
+def _summarize_documents(query: str, documents: list[RetrievedDocument], role: str) -> str:
+    instructions = INSTRUCTIONS_SUMMARIZATION.format(role=role)
+    prompt_tokens = count_tokens(f"{instructions}Documents:\n\n\nQuery: {query}", model=openai_settings.default_model)
+    documents_content = pack_documents(
+        documents=documents, 
+        token_budget=rag_settings.summarization_token_budget - prompt_tokens, 
+        model=openai_settings.default_model
+    )
     documents_as_str = "\n\n".join(documents_content)
     messages = [
-        {"role": "system", "content": INSTRUCTIONS_SUMMARIZATION.format(role=role)},
+        {"role": "system", "content": instructions},
         {"role": "user", "content": f"Documents:\n{documents_as_str}\n\nQuery: {query}"}
     ]
 
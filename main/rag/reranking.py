@@ -0,0 +1,180 @@
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from functools import cache
+from typing import Any, Optional
+
+from settings import get_settings
+from .types import RetrievedDocument
+
+rag_settings = get_settings().rag_settings
+
+
+class TokenCache:
+    """
+    Bounded LRU cache of the token ids of retrieved documents, keyed by the id of their Chunk, Paragraph or Section.
+    The text of these units doesn't change after ingestion, so they only have to be tokenized once.
+    """
+    def __init__(self, max_size: int, name: str) -> None:
+        self.max_size = max_size
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._token_ids: OrderedDict[uuid.UUID, list[int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_token_ids(self, tokenizer: Any, documents: list[RetrievedDocument], record_stats: bool = True) -> list[list[int]]:
+        """
+        Returns the token ids of the documents without special tokens, tokenizing only the uncached documents.
+        Only the first lookup of the documents of a query should record stats, since repeated lookups are always hits.
+        """
+        with self._lock:
+            uncached_documents = [doc for doc in documents if doc.id not in self._token_ids]
+        if uncached_documents:
+            # Tokenize outside the lock, so concurrent sessions don't wait on each other's tokenization.
+            texts = [doc.text for doc in uncached_documents]
+            new_token_ids = dict(zip((doc.id for doc in uncached_documents), tokenizer(texts, add_special_tokens=False)["input_ids"]))
+        else:
+            new_token_ids = {}
+
+        with self._lock:
+            if record_stats:
+                self.hits += len(documents) - len(uncached_documents)
+                self.misses += len(uncached_documents)
+            self._token_ids.update(new_token_ids)
+            result = []
+            for doc in documents:
+                # Another session can have evicted the token ids since they were looked up.
+                token_ids = self._token_ids.get(doc.id) or new_token_ids.get(doc.id)
+                if token_ids is None:
+                    token_ids = tokenizer(doc.text, add_special_tokens=False)["input_ids"]
+                self._token_ids[doc.id] = token_ids
+                self._token_ids.move_to_end(doc.id)
+                result.append(token_ids)
+            while len(self._token_ids) > self.max_size:
+                self._token_ids.popitem(last=False)
+            hits, misses = self.hits, self.misses
+
+        if record_stats:
+            logging.info(f"Token cache of {self.name}: {hits} hits, {misses} misses.")
+        return result
+
+
+def rerank_documents(query: str, documents: list[RetrievedDocument], top_n: int, min_score: float) -> list[RetrievedDocument]:
+    """
+    Reranks retrieved documents in multiple stages, so only the most promising documents reach the expensive cross-encoder:
+        1. The documents with the best retrieval scores are kept.
+        2. If a small prefilter model is configured, the documents it scores best are kept.
+        3. Documents are kept in ranking order while they fit in the token budget of the reranker.
+        4. The remaining documents are scored by the cross-encoder.
+    """
+    candidates = sorted(documents, key=lambda doc: doc.retrieval_score, reverse=True)[:rag_settings.prefilter_top_n]
+
+    if rag_settings.prefilter_model_path:
+        prefilter_scores = _score_documents(
+            query=query,
+            documents=candidates,
+            model_path=rag_settings.prefilter_model_path,
+            revision=rag_settings.prefilter_model_revision,
+            max_length=rag_settings.prefilter_model_max_length
+        )
+        ranked_candidates = sorted(zip(candidates, prefilter_scores), key=lambda x: x[1], reverse=True)
+        candidates = [doc for doc, score in ranked_candidates[:rag_settings.prefilter_model_top_n]]
+
+    candidates = _apply_token_budget(query=query, documents=candidates, token_budget=rag_settings.reranking_token_budget)
+    logging.info(f"Reranking {len(candidates)} of {len(documents)} retrieved documents.")
+    if not candidates:
+        return []
+
+    scores = _score_documents(
+        query=query,
+        documents=candidates,
+        model_path=rag_settings.reranker_model_path,
+        revision=rag_settings.reranker_model_revision,
+        max_length=rag_settings.reranker_max_length,
+        record_stats=False  # The token budget already looked up the candidates in the same cache.
+    )
+    for doc, score in zip(candidates, scores):
+        doc.rerank_score = score
+
+    ranked_documents = sorted(zip(candidates, scores), key=lambda item: item[1], reverse=True) # Reverse order improves summarization step slightly. For more info, see: https://arxiv.org/pdf/2407.01219
+    result = [doc for doc, score in ranked_documents[:top_n] if score >= min_score]
+
+    return result
+
+
+@cache
+def _load_model(model_path: str, revision: Optional[str]) -> tuple[Any, Any, Any]:
+    """Loads a cross-encoder and its tokenizer once per process. Torch and Transformers are only imported when a model is needed."""
+    import torch
+    from transformers import AutoTokenizer, AutoModelForSequenceClassification
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = AutoModelForSequenceClassification.from_pretrained(
+        model_path,
+        revision=revision,  # Ensures using a specific safe revision
+        trust_remote_code=True,
+        torch_dtype=torch.float16
+    )
+    model.to(device)
+    model.eval()
+    logging.info(f"Loaded reranking model: {model_path}.")
+
+    return tokenizer, model, device
+
+
+@cache
+def _get_token_cache(model_path: str) -> TokenCache:
+    """Returns the token cache for the tokenizer of a model."""
+    return TokenCache(max_size=rag_settings.token_cache_size, name=model_path)
+
+
+def _score_documents(
+    query: str, 
+    documents: list[RetrievedDocument], 
+    model_path: str, 
+    revision: Optional[str], 
+    max_length: int,
+    record_stats: bool = True
+) -> list[float]:
+    """Scores the relevance of documents to the query with a cross-encoder."""
+    import torch
+
+    tokenizer, model, device = _load_model(model_path, revision)
+    token_cache = _get_token_cache(model_path)
+
+    # Join the cached token ids of the documents with the freshly tokenized query instead of tokenizing the pairs from scratch.
+    query_ids = tokenizer(query, add_special_tokens=False)["input_ids"]
+    pairs = [
+        tokenizer.prepare_for_model(query_ids, doc_ids, truncation="longest_first", max_length=max_length)
+        for doc_ids in token_cache.get_token_ids(tokenizer, documents, record_stats=record_stats)
+    ]
+    with torch.no_grad():
+        inputs = tokenizer.pad(pairs, padding=True, return_tensors='pt')
+        inputs = {key: value.to(device) for key, value in inputs.items()}
+        scores = model(**inputs, return_dict=True).logits.view(-1, ).float()
+
+    return scores.tolist()
+
+
+def _apply_token_budget(query: str, documents: list[RetrievedDocument], token_budget: int) -> list[RetrievedDocument]:
+    """Keeps documents in ranking order as long as their query-document pairs fit in the token budget of the reranker."""
+    tokenizer, _, _ = _load_model(rag_settings.reranker_model_path, rag_settings.reranker_model_revision)
+    token_cache = _get_token_cache(rag_settings.reranker_model_path)
+
+    query_length = len(tokenizer(query)["input_ids"])
+    result = []
+    tokens_used = 0
+    for doc, doc_ids in zip(documents, token_cache.get_token_ids(tokenizer, documents)):
+        pair_length = min(query_length + len(doc_ids), rag_settings.reranker_max_length)
+        # Always rerank the best document, even if it exceeds the budget on its own.
+        if result and tokens_used + pair_length > token_budget:
+            continue
+        result.append(doc)
+        tokens_used += pair_length
+    logging.info(f"Reranking input: {tokens_used} of {token_budget} tokens.")
+
+    return result
@@ -1,8 +1,9 @@
 import uuid
+from dataclasses import dataclass, field
 from enum import Enum
 from typing import Optional
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel
 
 class ExtractedElementType(Enum):
     TITLE = "Title"
@@ -27,21 +28,45 @@ class ExtractedElements(BaseModel):
     elements: list[ExtractedElement]
 
 
-class UUIDBaseModel(BaseModel):
-    id: uuid.UUID = Field(default_factory=uuid.uuid4)
-
-
-class Chunk(UUIDBaseModel):
+# Chunks, Paragraphs and Sections are created by the thousands during ingestion, so they are slotted dataclasses instead of pydantic models.
+@dataclass(slots=True)
+class Chunk:
     paragraph_index: int
     text: str
     type: str
-    embeddings: Optional[list[float]] = None
+    id: uuid.UUID = field(default_factory=uuid.uuid4)
 
 
-class Paragraph(UUIDBaseModel):
+@dataclass(slots=True)
+class Paragraph:
     section_index: int
     chunks: list[Chunk]
+    id: uuid.UUID = field(default_factory=uuid.uuid4)
 
 
-class Section(UUIDBaseModel):
+@dataclass(slots=True)
+class Section:
     paragraphs: list[Paragraph]
+    id: uuid.UUID = field(default_factory=uuid.uuid4)
+
+
+class RetrievedChunk(BaseModel):
+    text: str
+    retrieval_score: Optional[float] = None  # Only set for Chunks that were returned by retrieval.
+
+
+class RetrievedDocument(BaseModel):
+    id: uuid.UUID
+    level: str  # "chunk", "paragraph" or "section"
+    text: str
+    retrieval_score: float  # Higher is better: a reciprocal rank fusion score with hybrid retrieval, otherwise a cosine similarity.
+    rerank_score: Optional[float] = None
+    chunks: list[RetrievedChunk] = []  # Chunks the document is built from, in document order.
+
+
+class IngestedDocument(BaseModel):
+    name: str
+    pages: int
+    chunks: int = 0
+    seconds: float
+    error: Optional[str] = None
@@ -0,0 +1,53 @@
+"""
+Reports the cold import time of the modules of the app. Each module is imported in a fresh interpreter,
+so the reported time includes the cost of all modules it imports itself.
+
+Usage:
+    python main/startup_report.py [module ...]
+"""
+import subprocess
+import sys
+from pathlib import Path
+
+MODULES = [
+    "settings",
+    "database.connection",
+    "database.context_store",
+    "database.vector_store",
+    "llm.openai_interface",
+    "llm.local_interface",
+    "llm.embeddings",
+    "llm.gemini_interface",
+    "rag.extraction",
+    "rag.ingestion",
+    "rag.reranking",
+    "rag.rag",
+]
+
+IMPORT_TIMER = "import importlib, time; start = time.perf_counter(); importlib.import_module('{module}'); print(time.perf_counter() - start)"
+
+
+def _measure_import_time(module: str) -> float:
+    """Returns the time in seconds it takes to import a module in a fresh interpreter."""
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_TIMER.format(module=module)],
+        cwd=Path(__file__).parent,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main() -> None:
+    modules = sys.argv[1:] or MODULES
+    print(f"{'module':<28} {'import time (ms)':>16}")
+    for module in modules:
+        try:
+            print(f"{module:<28} {_measure_import_time(module) * 1000:>16.1f}")
+        except subprocess.CalledProcessError as e:
+            print(f"{module:<28} {'failed':>16}  {e.stderr.strip().splitlines()[-1]}")
+
+
+if __name__ == "__main__":
+    main()